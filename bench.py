@@ -0,0 +1,314 @@
+"""Benchmarks for pydomintell.
+
+Runs against a local FakeDeth01Server, no controller needed:
+
+    python bench.py [--capture FILE] [--json OUT]
+                    [--baseline FILE] [--tolerance 0.2]
+
+With --baseline, exits with status 1 when a result regressed by more
+than the tolerance compared to a previous --json output.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import domintell.domintell as domintell
+from domintell.aio import AsyncDeth01Gateway
+from domintell.fake import FakeDeth01Server, load_capture
+
+# Results where a higher value is better, all others are costs.
+HIGHER_IS_BETTER = {'logic_fps', 'logic_many_fps', 'contention_writer_fps',
+                    'contention_reader_ops'}
+
+MODULES = ("IS8", "IS4", "DET", "BIR", "DMR", "BU1", "BU2", "BU4", "BU6",
+           "DIM", "AMP")
+
+
+def synthetic_capture(num_modules=200, num_frames=20000, seed=1):
+    """Return random status frames for a house of 'num_modules' modules."""
+    rand = random.Random(seed)
+    modules = [(rand.choice(MODULES), '%6X' % serial)
+               for serial in range(num_modules)]
+    frames = []
+    for _ in range(num_frames):
+        module, serial = rand.choice(modules)
+        if module == "DIM":
+            value = ''.join(rand.choice(("00", "FF", "7F", "10"))
+                            for _ in range(8))
+            frames.append(module + serial + "D" + value + "\r")
+        elif module == "AMP":
+            frames.append("%s%sO%d %d\r" % (module, serial,
+                                             rand.randint(1, 4),
+                                             rand.randint(0, 50)))
+        else:
+            frames.append("%s%s%s%02X\r" % (module, serial, rand.choice("IO"),
+                                             rand.randint(0, 255)))
+    return frames
+
+
+def bench_logic(frames):
+    """Frames per second decoded and applied by Gateway.logic."""
+    gateway = domintell.Gateway()
+    begin = time.perf_counter()
+    for frame in frames:
+        gateway.logic(frame)
+    elapsed = time.perf_counter() - begin
+    return {'logic_fps': len(frames) / elapsed}
+
+
+def bench_logic_many(frames, block=1000):
+    """Frames per second decoded and applied by Gateway.logic_many."""
+    gateway = domintell.Gateway()
+    begin = time.perf_counter()
+    for start in range(0, len(frames), block):
+        gateway.logic_many(frames[start:start + block])
+    elapsed = time.perf_counter() - begin
+    return {'logic_many_fps': len(frames) / elapsed}
+
+
+def bench_contention(frames, readers=4, block=1000):
+    """Writer throughput and reader calls per second with busy readers.
+
+    One thread applies the frames while the readers loop over
+    snapshot, get_many and changes_since.
+    """
+    gateway = domintell.Gateway()
+    gateway.logic_many(frames[:block])
+    ids = list(gateway.snapshot().sensors)[:16]
+    stop = threading.Event()
+    counts = [0] * readers
+
+    def read(index):
+        """Query the gateway until stopped."""
+        calls = 0
+        while not stop.is_set():
+            version = gateway.snapshot().version
+            gateway.get_many(ids)
+            gateway.changes_since(version - 1)
+            calls += 3
+        counts[index] = calls
+
+    threads = [threading.Thread(target=read, args=(index,))
+               for index in range(readers)]
+    for thread in threads:
+        thread.start()
+    begin = time.perf_counter()
+    for start in range(0, len(frames), block):
+        gateway.logic_many(frames[start:start + block])
+    elapsed = time.perf_counter() - begin
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return {'contention_writer_fps': len(frames) / elapsed,
+            'contention_reader_ops': sum(counts) / elapsed}
+
+
+def _latencies(send, wait, samples):
+    """Return the send to callback latencies in milliseconds."""
+    latencies = []
+    for sample in range(samples):
+        begin = time.monotonic()
+        send(["IS8  0001I%02X" % (sample % 2)])
+        done = wait()
+        if done is not None:
+            latencies.append((done - begin) * 1000.0)
+    return latencies
+
+
+def _summary(name, latencies):
+    """Return the median and 95th percentile of latencies."""
+    if not latencies:
+        return {}
+    latencies = sorted(latencies)
+    return {name + '_p50_ms': statistics.median(latencies),
+            name + '_p95_ms': latencies[int(len(latencies) * 0.95) - 1]}
+
+
+def bench_latency_thread(samples=100):
+    """Datagram to callback latency of Deth01Gateway."""
+    server = FakeDeth01Server()
+    server.start()
+    updated = threading.Event()
+    stamp = {}
+
+    def event(update_type, nid):
+        """Record the time of the update."""
+        stamp['time'] = time.monotonic()
+        updated.set()
+
+    gateway = domintell.Deth01Gateway(server.address[0], event,
+                                      port=server.address[1])
+    gateway.start()
+    while server.client is None or gateway.sock is None:
+        time.sleep(0.01)
+    server.send_lines(["IS8  0001I02"])
+    time.sleep(0.1)
+
+    def send(lines):
+        """Send and arm the wait."""
+        updated.clear()
+        server.send_lines(lines)
+
+    def wait():
+        """Wait for the callback."""
+        return stamp['time'] if updated.wait(1.0) else None
+
+    latencies = _latencies(send, wait, samples)
+    gateway.stop()
+    gateway.join()
+    server.stop()
+    return _summary('latency_thread', latencies)
+
+
+def bench_latency_asyncio(samples=100):
+    """Datagram to callback latency of AsyncDeth01Gateway."""
+    server = FakeDeth01Server()
+    server.start()
+
+    async def run():
+        """Measure on a fresh loop."""
+        loop = asyncio.get_running_loop()
+        state = {}
+
+        def event(update_type, nid):
+            """Record the time of the update."""
+            future = state.get('future')
+            if future is not None and not future.done():
+                future.set_result(time.monotonic())
+
+        gateway = AsyncDeth01Gateway(server.address[0], event,
+                                     port=server.address[1])
+        await gateway.start()
+        await gateway.wait_ready(2.0)
+        latencies = []
+        for sample in range(samples):
+            state['future'] = loop.create_future()
+            begin = time.monotonic()
+            server.send_lines(["IS8  0001I%02X" % (sample % 2)])
+            try:
+                done = await asyncio.wait_for(state['future'], 1.0)
+            except asyncio.TimeoutError:
+                continue
+            latencies.append((done - begin) * 1000.0)
+        await gateway.stop()
+        return latencies
+
+    latencies = asyncio.run(run())
+    server.stop()
+    return _summary('latency_asyncio', latencies)
+
+
+def bench_persistence(num_modules=200, events=200):
+    """Cost of persisting a single change, per file type."""
+    results = {}
+    frames = synthetic_capture(num_modules, num_modules * 4)
+    for ext in ('pickle', 'journal'):
+        with tempfile.TemporaryDirectory() as dirname:
+            gateway = domintell.Gateway(persistence_file=os.path.join(
+                dirname, 'bench.' + ext))
+            for frame in frames:
+                gateway.logic(frame)
+            gateway._flush_sensors()  # pylint: disable=protected-access
+            sensors = [nid for nid in gateway.sensors][:events]
+            begin = time.perf_counter()
+            for nid in sensors:
+                gateway._changed_ids.add(nid)  # pylint: disable=W0212
+                gateway._flush_sensors()  # pylint: disable=W0212
+            elapsed = time.perf_counter() - begin
+        results['persist_%s_us' % ext] = elapsed / len(sensors) * 1e6
+    return results
+
+
+# Result name -> module whose import time a fresh interpreter measures.
+IMPORTS = {
+    'import_decoder_ms': 'domintell.decoder',
+    'import_offline_ms': 'domintell.offline',
+    'import_gateway_ms': 'domintell.domintell',
+    'import_deth01_ms': 'domintell.deth01',
+}
+
+
+def bench_import(runs=5):
+    """Import time of the decoder core, the gateway and the transport.
+
+    Each import runs in a new interpreter, the best of 'runs' counts.
+    """
+    results = {}
+    for name, module in IMPORTS.items():
+        code = ('import time; begin = time.perf_counter(); import %s; '
+                'print(time.perf_counter() - begin)' % module)
+        results[name] = min(
+            float(subprocess.check_output([sys.executable, '-c', code],
+                                          cwd=os.path.dirname(
+                                              os.path.abspath(__file__))))
+            for _ in range(runs)) * 1000.0
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return the names of results that regressed against a baseline."""
+    regressions = []
+    for name, value in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        if name in HIGHER_IS_BETTER:
+            regressed = value < previous * (1.0 - tolerance)
+        else:
+            regressed = value > previous * (1.0 + tolerance)
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    """Run all benchmarks and report."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--capture', help='frames to decode, one per line')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--baseline', help='compare with a --json output')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.capture:
+        frames = load_capture(args.capture)
+    else:
+        frames = synthetic_capture()
+
+    results = {}
+    # Discovery prints every new sensor, keep the report readable.
+    with contextlib.redirect_stdout(io.StringIO()):
+        results.update(bench_logic(frames))
+        results.update(bench_logic_many(frames))
+        results.update(bench_contention(frames))
+        results.update(bench_latency_thread())
+        results.update(bench_latency_asyncio())
+        results.update(bench_persistence())
+        results.update(bench_import())
+
+    for name, value in sorted(results.items()):
+        print('%-28s %12.3f' % (name, value))
+    if args.json:
+        with open(args.json, 'w') as file_handle:
+            json.dump(results, file_handle, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as file_handle:
+            regressions = compare(results, json.load(file_handle),
+                                  args.tolerance)
+        if regressions:
+            print('Regressed:', ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,39 @@
-"""Python implementation of Domintell API."""
+"""Python implementation of Domintell API.
+
+Names are imported from their submodule on first access, so that
+'from domintell import decode' does not load the gateway, persistence
+or transports.
+"""
+from importlib import import_module
+
+# Public name -> submodule defining it.
+_EXPORTS = {
+    'decode': 'decoder',
+    'decode_block': 'decoder',
+    'parse_id': 'decoder',
+    'LineFramer': 'framing',
+    'Sensor': 'sensor',
+    'SensorType': 'sensor',
+    'Gateway': 'domintell',
+    'Deth01Gateway': 'deth01',
+    'AsyncDeth01Gateway': 'aio',
+    'GatewayPool': 'pool',
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    """Import an exported name from its submodule."""
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError('module %r has no attribute %r'
+                             % (__name__, name))
+    value = getattr(import_module('.' + module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    """List the exported names next to the loaded ones."""
+    return sorted(set(globals()) | set(_EXPORTS))
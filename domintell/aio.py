@@ -0,0 +1,278 @@
+"""Asyncio implementation of the Domintell DETH01 gateway."""
+import asyncio
+import logging
+
+from .domintell import KEEPALIVE_INTERVAL, Gateway
+from .framing import LineFramer
+from .scheduler import Backoff
+
+_LOGGER = logging.getLogger(__name__)
+
+SESSION_OPENED = "INFO:Session opened:INFO"
+
+
+class Deth01Protocol(asyncio.DatagramProtocol):
+    """Datagram protocol feeding received lines to a gateway."""
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.transport = None
+
+    def connection_made(self, transport):
+        """Open the session as soon as the endpoint exists."""
+        self.transport = transport
+        transport.sendto(b"LOGIN")
+
+    def datagram_received(self, data, addr):
+        """Split the datagram into lines and hand them to the gateway."""
+        self.feed(self.gateway, data)
+
+    def feed(self, gateway, data):
+        """Hand the complete lines of a datagram to a gateway."""
+        if gateway.metrics is not None:
+            gateway.metrics.count('datagrams')
+            gateway.metrics.count('bytes', len(data))
+        for line in gateway.framer.feed(data):
+            gateway.line_received(line)
+
+    def error_received(self, exc):
+        """Drop the session, the gateway will reconnect."""
+        _LOGGER.error('Receive from server failed: %s', exc)
+        self.gateway.connection_lost(self)
+
+    def connection_lost(self, exc):
+        """Notify the gateway that the endpoint is closed."""
+        self.gateway.connection_lost(self)
+
+
+class AsyncDeth01Gateway(Gateway):
+    """Domintell UDP ethernet gateway running on an asyncio event loop.
+
+    Many gateways can share the same loop. Received datagrams are
+    handled as they arrive, without polling.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+
+    def __init__(self, host, event_callback=None,
+                 persistence=False, persistence_file='domintell.pickle',
+                 port=17481, timeout=1.0,
+                 reconnect_timeout=10.0, loop=None, topology_cache=False):
+        """Setup asyncio UDP ethernet gateway."""
+        Gateway.__init__(self, event_callback, persistence,
+                         persistence_file, topology_cache)
+        self.server_address = (host, port)
+        self.timeout = timeout
+        self.reconnect_timeout = reconnect_timeout
+        # reconnect delays grow up to reconnect_timeout
+        self.backoff = Backoff(maximum=reconnect_timeout)
+        self.loop = loop
+        self.transport = None
+        self.protocol = None
+        self.framer = LineFramer()
+        self._session_opened = None
+        self._session_lost = None
+        self._task = None
+        self._flush_handle = None
+        self._commands_handle = None
+        self._acks_handle = None
+        self.commands.wakeup = self._wakeup_commands
+
+    async def start(self):
+        """Start the session task on the running loop."""
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        self._session_opened = asyncio.Event()
+        self._session_lost = asyncio.Event()
+        self._task = self.loop.create_task(self._run())
+
+    async def stop(self):
+        """Stop the session task and its timers, close the endpoint."""
+        _LOGGER.info('Stopping gateway %s', self.server_address)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for name in ('_commands_handle', '_acks_handle', '_flush_handle'):
+            handle = getattr(self, name)
+            if handle is not None:
+                handle.cancel()
+                setattr(self, name, None)
+        self.disconnect()
+        self._stop_persistence()
+
+    async def wait_ready(self, timeout=None):
+        """Wait until the session is opened."""
+        await asyncio.wait_for(self._session_opened.wait(), timeout)
+
+    async def connect(self):
+        """Open the endpoint and wait for the session to be opened."""
+        self._count('connects')
+        self._session_opened.clear()
+        self._session_lost.clear()
+        self.framer.reset()
+        try:
+            self.transport, self.protocol = \
+                await self.loop.create_datagram_endpoint(
+                    lambda: Deth01Protocol(self),
+                    remote_addr=self.server_address)
+        except OSError:
+            _LOGGER.error('Cannot open endpoint to %s', self.server_address)
+            self._count('connect_failures')
+            return False
+        try:
+            await asyncio.wait_for(self._session_opened.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            self._count('connect_failures')
+            self.disconnect()
+            return False
+        self._sendto("APPINFO")
+        return True
+
+    def disconnect(self):
+        """Close the endpoint."""
+        if self.transport is None:
+            return
+        _LOGGER.info('Closing endpoint at %s.', self.server_address)
+        transport, self.transport = self.transport, None
+        # the closed endpoint reports connection_lost later, ignore it
+        self.protocol = None
+        transport.close()
+        if self._session_opened is not None:
+            self._session_opened.clear()
+
+    async def _run(self):
+        """Keep the session open and alive."""
+        while True:
+            if self.transport is None:
+                if not await self.connect():
+                    delay = self.backoff.next()
+                    _LOGGER.info('Waiting %s secs before trying to connect '
+                                 'again.', delay)
+                    await asyncio.sleep(delay)
+                    continue
+                self.backoff.reset()
+            self._sendto("PING")
+            try:
+                await asyncio.wait_for(self._session_lost.wait(),
+                                       KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                continue
+            self.disconnect()
+
+    def line_received(self, line):
+        """Handle a complete line received from the gateway."""
+        if self.debug:
+            _LOGGER.debug('Received %s', line)
+        if not self._session_opened.is_set():
+            if line.rstrip() == SESSION_OPENED:
+                _LOGGER.info(SESSION_OPENED)
+                self._session_opened.set()
+                self._count_session()
+            return
+        self.logic(line)
+        if self._pending_events and self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.batch_window,
+                                                      self._flush_window)
+
+    def _flush_window(self):
+        """Deliver the changes collected during the batch window."""
+        self._flush_handle = None
+        self.flush_events(force=True)
+
+    def _wakeup_commands(self):
+        """Drain the command pipeline from the loop, any thread may call."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._drain_commands)
+
+    def _drain_commands(self):
+        """Send due commands and come back when the next one is due."""
+        if self._commands_handle is not None:
+            self._commands_handle.cancel()
+            self._commands_handle = None
+        delay = self.commands.process()
+        if delay is not None:
+            self._commands_handle = self.loop.call_later(
+                delay, self._drain_commands)
+        if self.acks and self._acks_handle is None:
+            self._acks_handle = self.loop.call_later(self.acks.timeout,
+                                                     self._expire_acks)
+
+    def _expire_acks(self):
+        """Retransmit unconfirmed commands until none is waiting."""
+        self._acks_handle = None
+        delay = self.acks.expire()
+        if delay is not None or self.acks:
+            self._acks_handle = self.loop.call_later(
+                self.acks.timeout if delay is None else delay,
+                self._expire_acks)
+
+    def connection_lost(self, protocol=None):
+        """Signal the session task that the endpoint went away.
+
+        Reports of a 'protocol' other than the current one come from
+        an endpoint already replaced and are ignored.
+        """
+        if protocol is not None and protocol is not self.protocol:
+            return
+        if self._session_lost is not None:
+            self._session_lost.set()
+
+    def _sendto(self, message):
+        """Send a datagram to the gateway."""
+        if self.transport is None:
+            _LOGGER.error('Send to server failed, no session.')
+            return
+        self.transport.sendto(message.encode('utf-8'))
+
+    def send(self, message):
+        """Write a command string to the gateway."""
+        if not message:
+            return
+        _LOGGER.debug('Sending %s', message)
+        self._sendto(message)
+
+    async def async_set_value(self, sensor_id, child_id, value_type, value,
+                              **kwargs):
+        """Set an output once the session is open."""
+        await self.wait_ready(self.timeout)
+        return self.set_value(sensor_id, child_id, value_type, value,
+                              **kwargs)
+
+    async def async_set_value_confirmed(self, sensor_id, child_id,
+                                        value_type, value, **kwargs):
+        """Set an output and wait until the gateway confirms it.
+
+        Returns True when confirmed, False when superseded and None
+        if the sensor is not an output. Raises TimeoutError when the
+        retransmissions got no confirmation.
+        """
+        await self.wait_ready(self.timeout)
+        future = self.set_value_confirmed(sensor_id, child_id, value_type,
+                                          value, **kwargs)
+        if future is None:
+            return None
+        return await asyncio.wrap_future(future)
+
+    async def async_set_values(self, values):
+        """Set many outputs and wait until all are done.
+
+        Returns {id: result} as set_values, raises ValueError for
+        unknown sensors or bad values.
+        """
+        await self.wait_ready(self.timeout)
+        return await asyncio.wrap_future(self.set_values(values))
+
+    async def async_get_value(self, sensor_id):
+        """Return the last known value of a sensor once the session is open.
+
+        Returns None for unknown sensors.
+        """
+        await self.wait_ready(self.timeout)
+        sensor = self.sensors.get(sensor_id)
+        if sensor is None:
+            return None
+        return sensor.value
@@ -0,0 +1,346 @@
+"""Outbound command pipeline of a Domintell gateway."""
+import functools
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from .decoder import parse_id
+from .sensor import SensorType
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_RATE = 20.0  # commands per second
+
+ON_VALUES = (1, "on")
+OFF_VALUES = (0, "off")
+MAX_DIM_LEVEL = 100
+
+
+def output_command(sensor, value):
+    """Return (command, expected value) setting a sensor to 'value'.
+
+    'sensor' is a Sensor or SensorState. Outputs take "on" / "off" or
+    1 / 0, DIM channels also take a level in 0..MAX_DIM_LEVEL and AMP
+    channels a volume. The expected value is the one the status frame
+    will report, None when it is not known. Raises ValueError for
+    other sensors or values.
+    """
+    if sensor.type is SensorType.AMPLI:
+        if isinstance(value, bool) or not isinstance(value, int) or \
+           value < 0:
+            raise ValueError('Bad volume for %s: %r' % (sensor.id, value))
+        return "%s%%V%d" % (sensor.id, value), str(value)
+    if sensor.type is not SensorType.OUTPUT:
+        raise ValueError('Not an output: %s' % sensor.id)
+    module, _, channel = parse_id(sensor.id)
+    if module == "DIM" and isinstance(value, int) and \
+       not isinstance(value, bool):
+        if not 0 <= value <= MAX_DIM_LEVEL:
+            raise ValueError('Bad level for %s: %r' % (sensor.id, value))
+        return "%s%%D%d" % (sensor.id, value), value
+    if value in ON_VALUES:
+        suffix, expected = "%I", "on"
+    elif value in OFF_VALUES:
+        suffix, expected = "%O", "off"
+    else:
+        raise ValueError('Bad value for %s: %r' % (sensor.id, value))
+    if module == "DIM":
+        expected = None  # the level is up to the module
+    target = sensor.id
+    if module.startswith("BU"):
+        # indicator outputs are numbered from 1 in commands
+        num_channels = int(module[2])
+        if channel > num_channels:
+            target = target[:10] + str(channel - num_channels)
+    return target + suffix, expected
+
+
+class Scene(object):
+    """Validated commands setting many outputs in one operation.
+
+    Built once by Gateway.scene, a scene can be run any number of
+    times without deriving its commands again.
+    """
+
+    __slots__ = ('commands',)
+
+    def __init__(self, commands):
+        self.commands = commands  # ((id, command, expected), ...)
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __repr__(self):
+        return 'Scene(%r)' % (self.commands,)
+
+
+def gather(futures):
+    """Return a future for a {target: future} dict of command futures.
+
+    It resolves to {target: result} once all of them are done, a
+    command that timed out gives False.
+    """
+    result = Future()
+    result.set_running_or_notify_cancel()
+    if not futures:
+        result.set_result({})
+        return result
+    outcomes = {}
+    lock = threading.Lock()
+
+    def done(target, future):
+        """Collect one outcome, resolve when it is the last one."""
+        try:
+            outcome = future.result()
+        except TimeoutError:
+            outcome = False
+        with lock:
+            outcomes[target] = outcome
+            complete = len(outcomes) == len(futures)
+        if complete:
+            result.set_result(outcomes)
+
+    for target, future in list(futures.items()):
+        future.add_done_callback(functools.partial(done, target))
+    return result
+
+
+class CommandPipeline(object):
+    """Thread-safe, paced queue of commands to the gateway.
+
+    Commands are keyed by their target output. A command submitted
+    while an earlier one to the same target is still queued replaces
+    it, keeping its place in the queue. The transport calls process()
+    to send the commands that are due, at most 'rate' per second.
+    """
+
+    def __init__(self, send, rate=DEFAULT_RATE, on_sent=None):
+        """Setup pipeline calling 'send' with each command string."""
+        self._send = send
+        self.rate = rate
+        self.on_sent = on_sent  # called with (target, command, latency)
+        self.wakeup = None  # called when the queue becomes non-empty
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()  # target -> (command, submit time)
+        self._next_send = 0.0
+        self.sent = 0
+        self.superseded = 0
+        self.latencies = deque(maxlen=256)
+
+    def submit(self, target, command):
+        """Queue a command, replacing a queued one to the same target."""
+        with self._lock:
+            was_empty = not self._pending
+            if target in self._pending:
+                self.superseded += 1
+            self._pending[target] = (command, time.monotonic())
+        if was_empty and self.wakeup is not None:
+            self.wakeup()
+
+    def submit_many(self, commands):
+        """Queue (target, command) pairs under a single wakeup."""
+        if not commands:
+            return
+        now = time.monotonic()
+        with self._lock:
+            was_empty = not self._pending
+            pending = self._pending
+            for target, command in commands:
+                if target in pending:
+                    self.superseded += 1
+                pending[target] = (command, now)
+        if was_empty and self.wakeup is not None:
+            self.wakeup()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def clear(self):
+        """Drop all queued commands."""
+        with self._lock:
+            self._pending.clear()
+
+    def process(self):
+        """Send the commands that are due.
+
+        Return the number of seconds until the next command is due,
+        or None when the queue is empty.
+        """
+        interval = 1.0 / self.rate if self.rate else 0.0
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                if not self._pending:
+                    return None
+                if now < self._next_send:
+                    return self._next_send - now
+                target, (command, submitted) = \
+                    self._pending.popitem(last=False)
+                self._next_send = now + interval
+            _LOGGER.debug('Sending %s', command)
+            self._send(command)
+            latency = time.monotonic() - submitted
+            self.sent += 1
+            self.latencies.append(latency)
+            if self.on_sent is not None:
+                try:
+                    self.on_sent(target, command, latency)
+                except Exception as exception:  # pylint: disable=W0703
+                    _LOGGER.exception(exception)
+
+    def stats(self):
+        """Return counters and recent send latencies in seconds."""
+        latencies = list(self.latencies)
+        return {
+            'queued': len(self._pending),
+            'sent': self.sent,
+            'superseded': self.superseded,
+            'latency_last': latencies[-1] if latencies else None,
+            'latency_mean': (sum(latencies) / len(latencies)
+                             if latencies else None),
+            'latency_max': max(latencies) if latencies else None,
+        }
+
+
+class PendingCommand(object):
+    """Command waiting for a status frame confirming its target value."""
+
+    __slots__ = ('target', 'expected', 'command', 'future', 'attempts',
+                 'sent', 'deadline')
+
+    def __init__(self, target, expected, command, future):
+        self.target = target
+        self.expected = expected
+        self.command = command
+        self.future = future
+        self.attempts = 0
+        self.sent = None
+        self.deadline = None
+
+
+class CommandTracker(object):
+    """Resolve command futures when the gateway confirms the new state.
+
+    A command is confirmed when the status of its target output
+    reaches the expected value. Unconfirmed commands are resubmitted
+    with exponential backoff, the future fails with TimeoutError once
+    the retries are exhausted. Round-trip times are recorded for
+    commands confirmed without retransmission.
+    """
+
+    def __init__(self, pipeline, timeout=1.0, retries=2, backoff=2.0):
+        """Setup tracker resubmitting commands through 'pipeline'."""
+        self.pipeline = pipeline
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self._pending = {}  # target -> PendingCommand
+        self.confirmed = 0
+        self.retransmits = 0
+        self.timeouts = 0
+        self.rtts = deque(maxlen=256)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def track(self, target, expected, command):
+        """Return a future for a command that is about to be submitted.
+
+        The future resolves to True when confirmed, or to False when
+        a newer command to the same target supersedes it.
+        """
+        future = Future()
+        future.set_running_or_notify_cancel()
+        pending = PendingCommand(target, expected, command, future)
+        with self._lock:
+            previous = self._pending.get(target)
+            self._pending[target] = pending
+        if previous is not None:
+            previous.future.set_result(False)
+        return future
+
+    def command_sent(self, target, command, latency):
+        """Start the confirmation timer once the pipeline sent a command.
+
+        A different command sent to the target replaced the tracked
+        one in the pipeline, which is then resolved to False.
+        """
+        # pylint: disable=unused-argument
+        now = time.monotonic()
+        with self._lock:
+            pending = self._pending.get(target)
+            if pending is None:
+                return
+            if pending.command != command:
+                del self._pending[target]
+            else:
+                pending.sent = now
+                pending.deadline = now + self.timeout * \
+                    self.backoff ** pending.attempts
+                pending.attempts += 1
+                return
+        pending.future.set_result(False)
+
+    def confirm(self, target, value):
+        """Resolve the command to 'target' if 'value' is the expected one."""
+        with self._lock:
+            pending = self._pending.get(target)
+            if pending is None or pending.expected != value:
+                return
+            del self._pending[target]
+            self.confirmed += 1
+            if pending.attempts == 1:
+                self.rtts.append(time.monotonic() - pending.sent)
+        pending.future.set_result(True)
+
+    def expire(self):
+        """Retransmit or fail commands whose deadline passed.
+
+        Return the number of seconds until the next deadline, or None
+        when nothing is waiting for a confirmation.
+        """
+        now = time.monotonic()
+        resend = []
+        failed = []
+        next_deadline = None
+        with self._lock:
+            for target, pending in list(self._pending.items()):
+                if pending.deadline is None:
+                    continue
+                if pending.deadline > now:
+                    if next_deadline is None or \
+                       pending.deadline < next_deadline:
+                        next_deadline = pending.deadline
+                elif pending.attempts > self.retries:
+                    del self._pending[target]
+                    self.timeouts += 1
+                    failed.append(pending)
+                else:
+                    pending.deadline = None
+                    self.retransmits += 1
+                    resend.append(pending)
+        for pending in resend:
+            _LOGGER.debug('Retransmitting %s', pending.command)
+            self.pipeline.submit(pending.target, pending.command)
+        for pending in failed:
+            pending.future.set_exception(TimeoutError(
+                'No confirmation for %s' % pending.command))
+        if next_deadline is None:
+            return None
+        return next_deadline - now
+
+    def stats(self):
+        """Return counters and recent round-trip times in seconds."""
+        rtts = list(self.rtts)
+        return {
+            'pending': len(self._pending),
+            'confirmed': self.confirmed,
+            'retransmits': self.retransmits,
+            'timeouts': self.timeouts,
+            'rtt_mean': sum(rtts) / len(rtts) if rtts else None,
+            'rtt_min': min(rtts) if rtts else None,
+            'rtt_max': max(rtts) if rtts else None,
+        }
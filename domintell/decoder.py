@@ -0,0 +1,328 @@
+"""Frame decoder for lines received from a Domintell gateway.
+
+Kept free of logging, threading and I/O so that decoding tools import
+it quickly. Transports split their bytes into lines with framing.
+"""
+import re
+from collections import namedtuple
+
+STATUS_REGEX = re.compile(r"[A-Z0-9]{3}[A-F0-9 ]{6}[IODTCSB]{1}.*\r")
+CLOCK_REGEX = re.compile(
+    r"[0-9]{2}:[0-9 ]{2} [0-9]{2}/[0-9]{2}/[0-9]{2}\r")
+
+# Prefixes of APPINFO lines that carry nothing we track.
+IGNORED_PREFIXES = ("STA", "APPINFO", "SFE", "ET2", "VAR", "SYS", "MEM")
+
+# Byte -> indices of its set bits, lowest first.
+SET_BITS = tuple(tuple(bit for bit in range(8) if byte >> bit & 1)
+                 for byte in range(256))
+
+# A single channel of a status frame, e.g. ("IS8001234-1", "input", "on").
+Channel = namedtuple('Channel', ['id', 'type', 'value'])
+# Status frame: module code, serial and the decoded channels.
+StatusFrame = namedtuple('StatusFrame', ['module', 'serial', 'channels'])
+# Status frame of a mask module, not yet split into channels. The key
+# is the module id, e.g. "IS8001234".
+MaskFrame = namedtuple('MaskFrame', ['key', 'module_type', 'bank', 'mask'])
+# APPINFO description of a single channel.
+InfoFrame = namedtuple('InfoFrame', ['id', 'type', 'desc'])
+# Date/time broadcast by the gateway every minute.
+ClockFrame = namedtuple('ClockFrame', ['value'])
+# Session control lines, e.g. "PONG" or "END APPINFO".
+ControlFrame = namedtuple('ControlFrame', ['command'])
+# Lines that are understood but deliberately not tracked.
+IgnoredFrame = namedtuple('IgnoredFrame', ['data'])
+# Lines that could not be decoded.
+UnknownFrame = namedtuple('UnknownFrame', ['data'])
+
+
+def module_id(data):
+    """Return the normalised module id ("IS8001234") of a frame."""
+    return data[:9].replace(' ', '0')
+
+
+def parse_id(nid):
+    """Split a sensor id "IS80012AB-1" into ("IS8", 0x12AB, 1).
+
+    Returns (None, None, None) for ids without module, e.g. "clock".
+    """
+    module, _, channel = nid.partition('-')
+    try:
+        return module[:3], int(module[3:], 16), int(channel, 16)
+    except ValueError:
+        return None, None, None
+
+
+class ModuleType(object):
+    """Base decoder for a Domintell module type.
+
+    Subclasses decode the status frames and the APPINFO lines of
+    one 3-character module code. Modules reporting their channels
+    as a hex value implement decode_mask, bank_channels and
+    channel_values, which let a gateway apply only changed channels.
+    """
+
+    code = None
+
+    def __init__(self, code):
+        self.code = code
+
+    def decode_mask(self, io_type, value):
+        """Return (bank, mask) of a status value, None if not a mask."""
+        # pylint: disable=unused-argument,no-self-use
+        return None
+
+    def bank_channels(self, bank):
+        """Return the (id suffix, sensor type) of the channels of a bank."""
+        # pylint: disable=unused-argument,no-self-use
+        return ()
+
+    def channel_values(self, mask, changed=None):
+        """Yield (index, value) of the channels, or of the changed ones.
+
+        'changed' is the mask XOR the previous mask of the bank.
+        """
+        # pylint: disable=unused-argument,no-self-use
+        return iter(())
+
+    def decode_status(self, data, io_type, value):
+        """Return the list of channels carried by a status frame."""
+        decoded = self.decode_mask(io_type, value)
+        if decoded is None:
+            return []
+        bank, mask = decoded
+        prefix = module_id(data)
+        channels = self.bank_channels(bank)
+        return [Channel(prefix + channels[index][0], channels[index][1],
+                        channel_value)
+                for index, channel_value in self.channel_values(mask)]
+
+    def channel_type(self, channel):
+        """Return the sensor type of a hex channel, None if not tracked."""
+        # pylint: disable=unused-argument,no-self-use
+        return None
+
+    def decode_info(self, data):
+        """Decode an APPINFO line, without the trailing '\\r'."""
+        sensor_type = self.channel_type(data[10:11])
+        if sensor_type is None:
+            return IgnoredFrame(data)
+        return InfoFrame(data[0:11].replace(' ', '0'), sensor_type,
+                         data[11:].split("[")[0])
+
+
+def _bank(first, last, sensor_type, fmt='{}'):
+    """Return the (id suffix, sensor type) of channels first..last."""
+    return tuple(('-' + fmt.format(channel), sensor_type)
+                 for channel in range(first, last + 1))
+
+
+class BitmaskModule(ModuleType):
+    """Module reporting its channels as a hex bitmask."""
+
+    def __init__(self, code, num_channels, sensor_type):
+        ModuleType.__init__(self, code)
+        self.num_channels = num_channels
+        self.sensor_type = sensor_type
+        self.all_channels = (1 << num_channels) - 1
+        self.banks = (_bank(1, num_channels, sensor_type),)
+
+    def decode_mask(self, io_type, value):
+        """A single bank, one bit per channel."""
+        return 0, int(value, 16)
+
+    def bank_channels(self, bank):
+        """Channels of a bank."""
+        return self.banks[bank]
+
+    def channel_values(self, mask, changed=None):
+        """Yield "on"/"off" for each set bit of 'changed'."""
+        if changed is None:
+            changed = self.all_channels
+        else:
+            changed &= self.all_channels
+        if changed <= 0xFF:
+            for index in SET_BITS[changed]:
+                yield index, "on" if mask >> index & 1 else "off"
+            return
+        while changed:
+            bit = changed & -changed
+            changed ^= bit
+            yield bit.bit_length() - 1, "on" if mask & bit else "off"
+
+    def channel_type(self, channel):
+        """All channels share the module sensor type."""
+        return self.sensor_type
+
+
+class PushButtonModule(BitmaskModule):
+    """BUx push button module with inputs and indicator outputs.
+
+    Inputs are numbered 1..n, outputs n+1..2n in hex. Status frames
+    carry either the inputs (bank 0) or the outputs (bank 1).
+    """
+
+    def __init__(self, code, num_channels):
+        BitmaskModule.__init__(self, code, num_channels, "input")
+        self.banks = (_bank(1, num_channels, "input"),
+                      _bank(num_channels + 1, 2 * num_channels, "output",
+                            '{:X}'))
+
+    def decode_mask(self, io_type, value):
+        """The io type selects the bank."""
+        return 0 if io_type == "I" else 1, int(value, 16)
+
+    def channel_type(self, channel):
+        """Channels above the button count are outputs."""
+        if int(channel, 16) > self.num_channels:
+            return "output"
+        return "input"
+
+
+class DimmerModule(ModuleType):
+    """DIM module reporting one byte level per channel."""
+
+    def __init__(self, code, num_channels=8):
+        ModuleType.__init__(self, code)
+        self.num_digits = 2 * num_channels
+        self.shifts = tuple(8 * (num_channels - channel)
+                            for channel in range(1, num_channels + 1))
+        self.banks = (_bank(1, num_channels, "output"),)
+
+    def decode_mask(self, io_type, value):
+        """All levels as a single integer, first channel first."""
+        value = value[:self.num_digits]
+        if len(value) < self.num_digits:
+            raise ValueError('Short dimmer status %r' % value)
+        return 0, int(value.replace(' ', '0'), 16)
+
+    def bank_channels(self, bank):
+        """Channels of a bank."""
+        return self.banks[bank]
+
+    def channel_values(self, mask, changed=None):
+        """Yield the integer level of each changed byte."""
+        for index, shift in enumerate(self.shifts):
+            if changed is None or changed >> shift & 0xFF:
+                yield index, mask >> shift & 0xFF
+
+    def channel_type(self, channel):
+        """All channels are outputs."""
+        return "output"
+
+
+class AmpModule(ModuleType):
+    """AMP module, one frame per amplifier channel."""
+
+    def decode_status(self, data, io_type, value):
+        """The channel is the first character of the value."""
+        return [Channel(module_id(data) + "-" + data[10], "ampli",
+                        data[12:])]
+
+    def channel_type(self, channel):
+        """All channels are amplifier outputs."""
+        return "ampli"
+
+
+class IgnoredModule(ModuleType):
+    """Known module type whose frames are not tracked."""
+
+    def decode_info(self, data):
+        """Nothing to describe."""
+        return IgnoredFrame(data)
+
+
+MODULE_TYPES = {}
+
+
+def register_module_type(module_type):
+    """Register a decoder for a module code, replacing any existing one."""
+    MODULE_TYPES[module_type.code] = module_type
+    return module_type
+
+
+for _module_type in (BitmaskModule("IS8", 8, "input"),
+                     BitmaskModule("IS4", 4, "input"),
+                     BitmaskModule("DET", 1, "input"),
+                     BitmaskModule("BIR", 8, "output"),
+                     BitmaskModule("DMR", 5, "output"),
+                     PushButtonModule("BU1", 1),
+                     PushButtonModule("BU2", 2),
+                     PushButtonModule("BU4", 4),
+                     PushButtonModule("BU6", 6),
+                     DimmerModule("DIM"),
+                     AmpModule("AMP"),
+                     IgnoredModule("VAR"),
+                     IgnoredModule("SYS"),
+                     IgnoredModule("SFE")):
+    register_module_type(_module_type)
+
+
+def decode_block(lines):
+    """Decode many lines at once, as decode(line, masks=True) would.
+
+    Returns the list of frames, None for malformed lines. Status
+    frames of mask modules, the bulk of any replay or APPINFO, are
+    decoded inline without going through decode.
+    """
+    frames = []
+    append = frames.append
+    status_match = STATUS_REGEX.match
+    module_types = MODULE_TYPES
+    for data in lines:
+        if data != "PONG\r" and status_match(data):
+            module_type = module_types.get(data[:3])
+            if module_type is not None:
+                try:
+                    decoded = module_type.decode_mask(data[9], data[10:-1])
+                except ValueError:
+                    append(None)
+                    continue
+                if decoded is not None:
+                    append(MaskFrame(data[:9].replace(' ', '0'),
+                                     module_type, decoded[0], decoded[1]))
+                    continue
+        try:
+            append(decode(data, masks=True))
+        except ValueError:
+            append(None)
+    return frames
+
+
+def decode(data, masks=False):
+    """Decode a single line received from the gateway.
+
+    The line still carries its trailing '\\r'. Raises ValueError
+    when a recognised frame has a malformed value. When 'masks' is
+    True, status frames of mask modules are returned as MaskFrame.
+    """
+    if data == "PONG\r":
+        return ControlFrame("PONG")
+
+    if STATUS_REGEX.match(data):
+        data = data[:-1]
+        module_type = MODULE_TYPES.get(data[:3])
+        if module_type is None:
+            return UnknownFrame(data)
+        if masks:
+            decoded = module_type.decode_mask(data[9], data[10:])
+            if decoded is not None:
+                return MaskFrame(module_id(data), module_type, decoded[0],
+                                 decoded[1])
+        return StatusFrame(data[:3], data[3:9], module_type.decode_status(
+            data, data[9], data[10:]))
+
+    if CLOCK_REGEX.match(data):
+        return ClockFrame(data)
+
+    module_type = MODULE_TYPES.get(data[:3])
+    if module_type is not None:
+        return module_type.decode_info(data[:-1])
+
+    if data.startswith("END APPINFO"):
+        return ControlFrame("END APPINFO")
+
+    if data.startswith(IGNORED_PREFIXES):
+        return IgnoredFrame(data)
+
+    return UnknownFrame(data)
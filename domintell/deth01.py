@@ -0,0 +1,321 @@
+"""Threaded UDP transport for the Domintell DETH01 gateway."""
+import logging
+import select
+import socket
+import threading
+import time
+
+from .domintell import KEEPALIVE_INTERVAL, PONG_TIMEOUT, Gateway
+from .framing import LineFramer
+from .scheduler import Backoff, Scheduler
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Deth01Gateway(Gateway, threading.Thread):
+    """Domintell UDP ethernet gateway.
+
+    The thread sleeps in select until a datagram arrives, another
+    thread wakes it up or its next timer is due: keepalive PING, PONG
+    timeout, reconnect, command pacing, retransmission or batch flush.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+
+    def __init__(self, host, event_callback=None,
+                 persistence=False, persistence_file='domintell.pickle',
+                 port=17481, timeout=1.0,
+                 reconnect_timeout=10.0, topology_cache=False):
+        """Setup UDP ethernet gateway."""
+        threading.Thread.__init__(self)
+        Gateway.__init__(self, event_callback, persistence,
+                         persistence_file, topology_cache)
+        self.sock = None
+        self.server_address = (host, port)
+        self.timeout = timeout
+        self.reconnect_timeout = reconnect_timeout
+        self.keepalive_interval = KEEPALIVE_INTERVAL
+        self.pong_timeout = PONG_TIMEOUT
+        # reconnect delays grow up to reconnect_timeout
+        self.backoff = Backoff(maximum=reconnect_timeout)
+        self.scheduler = Scheduler()
+        self._ping_sent = None
+        # reused for every datagram, large enough for any of them
+        self._recv_buffer = bytearray(65536)
+        self._framer = LineFramer()
+        self.max_lines_per_pass = 1000  # lines applied between sends
+        self._stop_event = threading.Event()
+        # written by other threads to interrupt the select of run
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self.commands.wakeup = self._wakeup
+
+    def connect(self):
+        """Connect to the Domintell system, on host and port."""
+        if self.sock == None:
+            self.sock = socket.socket(socket.AF_INET, # Internet
+                                      socket.SOCK_DGRAM) # UDP
+            self.sock.setsockopt(socket.SOL_SOCKET,
+                                 socket.SO_REUSEADDR,
+                                 1)
+            self.sock.setblocking(False)
+        self._framer.reset()
+        self._count('connects')
+        try:
+            self.sock.sendto(bytes("LOGIN", 'UTF-8'), self.server_address)
+        except OSError:
+            print('Server socket %s has an error.', self.sock)
+            self._count('connect_failures')
+            self.disconnect()
+            return False
+        # Lines sent before the session is opened are dropped.
+        deadline = time.monotonic() + self.timeout
+        opened = False
+        while not opened and self.sock is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            string = self.recv_timeout(remaining)
+            if not string:
+                break
+            opened = "INFO:Session opened:INFO" in string.splitlines()
+        if opened and self.sock is not None:
+            print("INFO:Session opened:INFO")
+            self._count_session()
+            self.sock.sendto(bytes("APPINFO", 'UTF-8'),
+                             self.server_address)
+            return True
+
+        self._count('connect_failures')
+        self.disconnect()
+        return False
+
+    def disconnect(self):
+        """Close the socket."""
+        if not self.sock:
+            return
+        _LOGGER.info('Closing socket at %s.', self.server_address)
+        #self.sock.shutdown(socket.SHUT_WR)
+        self.sock.close()
+        self.sock = None
+        _LOGGER.info('Socket closed at %s.', self.server_address)
+
+    def stop(self):
+        """Stop the background thread."""
+        _LOGGER.info('Stopping thread')
+        self._stop_event.set()
+        self._wakeup()
+
+    def _wakeup(self):
+        """Interrupt the wait of the background thread, any thread may call."""
+        try:
+            self._wakeup_send.send(b'\0')
+        except OSError:
+            pass  # buffer full, a wakeup is already pending
+
+    def fill_queue(self, func, args=None, kwargs=None, queue=None):
+        """Put a function in a queue and wake the background thread."""
+        Gateway.fill_queue(self, func, args, kwargs, queue)
+        self._wakeup()
+
+    def _wait(self, timeout):
+        """Sleep until data, a wakeup or the timeout.
+
+        Return True when the gateway socket is readable.
+        """
+        readers = [self._wakeup_recv]
+        if self.sock is not None:
+            readers.append(self.sock)
+        readable, _, errored = select.select(readers, [], readers[1:],
+                                             timeout)
+        if errored:
+            raise OSError
+        if self._wakeup_recv in readable:
+            try:
+                while self._wakeup_recv.recv(4096):
+                    pass
+            except BlockingIOError:
+                pass
+        return self.sock is not None and self.sock in readable
+
+    def recv_timeout(self, timeout=None):
+        """Receive complete lines from server, with a timeout.
+
+        Returns the lines, each terminated by '\\n', or an empty string
+        when no complete line arrived in time or the thread is stopping.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        lines = []
+        begin = time.monotonic()
+        while (not lines and self.sock is not None and
+               not self._stop_event.is_set()):
+            remaining = timeout - (time.monotonic() - begin)
+            if remaining <= 0:
+                break
+            try:
+                if not self._wait(remaining):
+                    continue  # woken up, check for stop
+            except OSError:
+                _LOGGER.error('Receive from server failed.')
+                self._connection_lost()
+                break
+            lines.extend(self.read_lines())
+        return ''.join(line + '\n' for line in lines)
+
+    def _sendto(self, message):
+        """Send a datagram to the gateway."""
+        self.sock.sendto(bytes(message, 'UTF-8'), self.server_address)
+
+    def send(self, message):
+        """Write a command string to the gateway via the socket."""
+        if not message:
+            return
+        with self.lock:
+            try:
+                # Send data
+                _LOGGER.debug('Sending %s', message)
+                self._sendto(message)
+
+            except OSError:
+                # Send failed
+                _LOGGER.error('Send to server failed.')
+                self._connection_lost()
+
+    def read_lines(self, max_lines=None):
+        """Yield the complete lines received on the socket.
+
+        Reads the datagrams already waiting on the non-blocking socket
+        and yields their complete lines. An uncompleted last line is
+        kept for the next datagram. No new datagram is read once
+        'max_lines' lines were yielded, the rest waits in the socket
+        buffer until the next call.
+        """
+        if max_lines is None:
+            max_lines = self.max_lines_per_pass
+        count = 0
+        while count < max_lines and self.sock is not None:
+            try:
+                size = self.sock.recv_into(self._recv_buffer)
+            except BlockingIOError:
+                return
+            except OSError:
+                _LOGGER.error('Receive from server failed.')
+                self._connection_lost()
+                return
+            if not size:
+                return
+            if self.metrics is not None:
+                self.metrics.count('datagrams')
+                self.metrics.count('bytes', size)
+            for line in self._framer.feed(self._recv_buffer, size):
+                count += 1
+                yield line
+
+    def _process_outbound(self):
+        """Run queued functions and send due commands."""
+        while not self.queue.empty() and self.sock is not None:
+            response = self.handle_queue()
+            if response is not None:
+                self.send(response)
+        if self.commands and self.sock is not None:
+            delay = self.commands.process()
+            if delay is not None:
+                self.scheduler.call_later('commands', delay,
+                                          self._process_outbound)
+        if self.acks and 'acks' not in self.scheduler:
+            self.scheduler.call_later('acks', self.acks.timeout,
+                                      self._expire_acks)
+
+    def _expire_acks(self):
+        """Retransmit unconfirmed commands until none is waiting."""
+        delay = self.acks.expire()
+        if delay is not None or self.acks:
+            self.scheduler.call_later(
+                'acks', self.acks.timeout if delay is None else delay,
+                self._expire_acks)
+        # retransmissions go through the paced pipeline
+        self._process_outbound()
+
+    def _try_connect(self):
+        """Open the session, or try again after a backoff delay."""
+        if self.connect():
+            self.backoff.reset()
+            self._keepalive()
+            self._process_outbound()
+            return
+        delay = self.backoff.next()
+        print('Waiting %s secs before trying to connect again.', delay)
+        self.scheduler.call_later('connect', delay, self._try_connect)
+
+    def _keepalive(self):
+        """Send a PING and expect its PONG within pong_timeout."""
+        if self.sock is None:
+            return  # reconnecting, connect starts the keepalive again
+        self._sendto("PING")
+        self._ping_sent = time.monotonic()
+        self.scheduler.call_later('pong', self.pong_timeout,
+                                  self._check_pong)
+        self.scheduler.call_later('keepalive', self.keepalive_interval,
+                                  self._keepalive)
+
+    def _check_pong(self):
+        """Drop the session when the last PING was not answered."""
+        if self.last_pong is None or self.last_pong < self._ping_sent:
+            _LOGGER.error('No PONG from %s within %s secs.',
+                          self.server_address, self.pong_timeout)
+            self._connection_lost()
+
+    def _connection_lost(self):
+        """Close the socket and reconnect right away.
+
+        Every socket failure ends here, so that the timers of the lost
+        session are cancelled and a reconnect is scheduled.
+        """
+        self.disconnect()
+        for name in ('keepalive', 'pong', 'commands'):
+            self.scheduler.cancel(name)
+        self.scheduler.call_later('connect', 0, self._try_connect)
+
+    def _flush_window(self):
+        """Deliver the changes collected during the batch window."""
+        self.flush_events(force=True)
+
+    def run(self):
+        """Background thread that reads messages from the gateway."""
+        scheduler = self.scheduler
+        scheduler.call_later('connect', 0, self._try_connect)
+
+        while not self._stop_event.is_set():
+            try:
+                delay = scheduler.run_due()
+                if self.sock is not None:
+                    self._process_outbound()
+            except OSError:
+                _LOGGER.error('Send to server failed.')
+                self._connection_lost()
+                continue
+            if self._pending_events and 'flush' not in scheduler:
+                scheduler.call_at('flush',
+                                  self._pending_since + self.batch_window,
+                                  self._flush_window)
+                delay = scheduler.run_due()
+            if self.metrics is not None:
+                self.metrics.gauge('queue_depth', self.queue.qsize())
+            if self._stop_event.is_set():
+                break
+
+            try:
+                # Sleep until data arrives or the next timer is due.
+                readable = self._wait(delay)
+            except OSError:
+                print('Server socket %s has an error.', self.sock)
+                self._connection_lost()
+                continue
+            if readable:
+                self.logic_many(list(self.read_lines()))
+        self.disconnect()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+        self._stop_persistence()
@@ -0,0 +1,183 @@
+"""Run gateway callbacks away from the reader thread."""
+import logging
+import threading
+import time
+from collections import deque
+
+_LOGGER = logging.getLogger(__name__)
+
+# What submit does when the executor is full.
+COALESCE = 'coalesce'  # merge into the pending event of the same key
+DROP_OLDEST = 'drop_oldest'  # drop the oldest pending event
+DROP_NEW = 'drop_new'  # drop the submitted event
+POLICIES = (COALESCE, DROP_OLDEST, DROP_NEW)
+
+
+class CallbackExecutor(object):
+    """Bounded executor keeping the events of a key in order.
+
+    Events are spread over worker threads by key, so events of one
+    sensor run in order while a slow consumer of one sensor does not
+    hold up the others. With a loop, events run on that asyncio loop
+    instead. When 'max_pending' events are waiting, 'policy' decides
+    what happens to a new event. With COALESCE, it is merged into the
+    pending event of the same key, so no key loses its latest event;
+    an event of a key with nothing pending is queued beyond the limit,
+    which then grows by at most one event per key. The other policies
+    drop an event.
+    """
+
+    def __init__(self, workers=2, max_pending=1000, policy=COALESCE,
+                 loop=None):
+        """Setup executor, worker threads start on first submit."""
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy %r' % policy)
+        self.max_pending = max_pending
+        self.policy = policy
+        self.loop = loop
+        self._lock = threading.Lock()
+        num_shards = 1 if loop is not None else workers
+        self._shards = [deque() for _ in range(num_shards)]
+        self._conditions = [threading.Condition(self._lock)
+                            for _ in range(num_shards)]
+        self._latest = {}  # key -> last pending entry of that key
+        self._pending = 0
+        self._threads = []
+        self._stopping = False
+        self.executed = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.max_lag = 0.0
+        self.on_lag = None  # called with the lag of every event
+
+    def __len__(self):
+        return self._pending
+
+    def submit(self, key, func, *args, merge=None):
+        """Queue func(*args) behind the pending events of 'key'.
+
+        When COALESCE applies, merge(pending args, args) returns the
+        args of the combined event, or None to queue the event on its
+        own. Without merge, the new args replace the pending ones.
+        """
+        index = hash(key) % len(self._shards)
+        with self._lock:
+            if self._stopping:
+                return
+            shard = self._shards[index]
+            if self._pending >= self.max_pending and \
+               not self._make_room(key, shard, func, args, merge):
+                return
+            entry = [key, func, args, time.monotonic()]
+            shard.append(entry)
+            self._latest[key] = entry
+            self._pending += 1
+            was_empty = len(shard) == 1
+            if self.loop is None:
+                self._conditions[index].notify()
+        if self.loop is not None:
+            if was_empty:
+                self.loop.call_soon_threadsafe(self._drain)
+        elif not self._threads:
+            self._start_workers()
+
+    def _make_room(self, key, shard, func, args, merge):
+        """Apply the policy, return False when the event is handled."""
+        # pylint: disable=too-many-arguments
+        if self.policy == COALESCE:
+            entry = self._latest.get(key)
+            if entry is None:
+                return True
+            if merge is not None:
+                args = merge(entry[2], args)
+                if args is None:
+                    return True
+            entry[1], entry[2] = func, args
+            self.coalesced += 1
+            return False
+        if self.policy == DROP_OLDEST and shard:
+            oldest = shard.popleft()
+            if self._latest.get(oldest[0]) is oldest:
+                del self._latest[oldest[0]]
+            self._pending -= 1
+            self.dropped += 1
+            return True
+        self.dropped += 1
+        return False
+
+    def _pop(self, shard):
+        """Take the next entry of a shard, lock held."""
+        entry = shard.popleft()
+        if self._latest.get(entry[0]) is entry:
+            del self._latest[entry[0]]
+        self._pending -= 1
+        return entry
+
+    def _execute(self, entry):
+        """Run an entry and record how far behind it was."""
+        lag = time.monotonic() - entry[3]
+        if lag > self.max_lag:
+            self.max_lag = lag
+        if self.on_lag is not None:
+            self.on_lag(lag)
+        try:
+            entry[1](*entry[2])
+        except Exception as exception:  # pylint: disable=W0703
+            _LOGGER.exception(exception)
+        self.executed += 1
+
+    def _start_workers(self):
+        """Start one worker thread per shard."""
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(len(self._shards)):
+                thread = threading.Thread(
+                    target=self._work, args=(index,),
+                    name='domintell-callback-%d' % index)
+                thread.daemon = True
+                self._threads.append(thread)
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self, index):
+        """Worker thread running the events of a shard."""
+        shard = self._shards[index]
+        condition = self._conditions[index]
+        while True:
+            with self._lock:
+                while not shard and not self._stopping:
+                    condition.wait()
+                if not shard:
+                    return
+                entry = self._pop(shard)
+            self._execute(entry)
+
+    def _drain(self):
+        """Run the pending events on the loop."""
+        shard = self._shards[0]
+        while True:
+            with self._lock:
+                if not shard:
+                    return
+                entry = self._pop(shard)
+            self._execute(entry)
+
+    def stop(self):
+        """Run the pending events and stop the worker threads."""
+        with self._lock:
+            self._stopping = True
+            for condition in self._conditions:
+                condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        """Return counters, pending events and the worst lag seen."""
+        return {
+            'pending': self._pending,
+            'executed': self.executed,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'max_lag': self.max_lag,
+        }
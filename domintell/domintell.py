@@ -1,347 +1,550 @@
 """pydomintell - Python implementation of the Domintell Gateway."""
-import re
 import logging
 import os
-import pickle
-import select
-import socket
 import threading
 import time
 from collections import deque
-from importlib import import_module
+from concurrent.futures import Future
 from queue import Queue
+from types import MappingProxyType
+
+from .commands import (CommandPipeline, CommandTracker, Scene, gather,
+                       output_command)
+from .decoder import (ClockFrame, ControlFrame, IgnoredFrame, InfoFrame,
+                      MaskFrame, StatusFrame, UnknownFrame, decode,
+                      decode_block)
+from .history import SensorHistory
+from .sensor import (Changes, Generation, ModuleChannels, Sensor, SensorType,
+                     Snapshot, saved_state, upgrade_sensors)
+from .stats import Metrics
+from .subscriptions import Subscription, SubscriptionIndex
 
 _LOGGER = logging.getLogger(__name__)
 
+# Persistence (pickle) and the UDP transport (socket, select) are only
+# imported when used, so decoding tools start fast, see bench_import.
+# pylint: disable=import-outside-toplevel
+
+KEEPALIVE_INTERVAL = 60.0  # seconds between PINGs
+PONG_TIMEOUT = 10.0  # seconds a PING may stay unanswered
+CHANGE_LOG_SIZE = 10000  # generations kept for changes_since
+
+# Metric names of frames that do not belong to a module type.
+FRAME_KINDS = {
+    InfoFrame: 'appinfo',
+    ClockFrame: 'clock',
+    ControlFrame: 'control',
+    IgnoredFrame: 'ignored',
+    UnknownFrame: 'unknown',
+}
+
 # pylint: disable=too-many-lines
 
 class Gateway(object):
-    """Base implementation for a Domintell Gateway."""
+    """Base implementation for a Domintell Gateway.
+
+    Threading model: the thread calling logic (the reader thread of a
+    transport) is the only writer of sensors and modules. After each
+    line or block it publishes an immutable generation of the sensor
+    states with a single reference swap. Other threads read through
+    snapshot, get_many and changes_since without taking locks, and
+    must not touch sensors directly; the command methods (set_value,
+    scene, ...) read the published generation too. Commands are
+    queued in the thread-safe command pipeline and sent by the
+    transport. Saving sensors pickles a published generation.
+    Callbacks run on the reader thread may read sensors, those run on
+    a callback executor must use snapshot. Callbacks run while a
+    frame is applied still see the previous generation.
+    """
 
     # pylint: disable=too-many-instance-attributes
 
     def __init__(self, event_callback=None, persistence=False,
-                 persistence_file='domintell.pickle',):
+                 persistence_file='domintell.pickle', topology_cache=False):
         self.queue = Queue()
         self.lock = threading.Lock()
         self.event_callback = event_callback
         self.sensors = {}
+        # Immutable states published for other threads, see snapshot()
+        self._generation = Generation.from_sensors(0, self.sensors)
+        # ChangeNodes kept reachable for changes_since
+        self._change_nodes = deque([self._generation.changes])
+        self._unpublished = []  # ids changed since the last publish
+        # (module id, bank) -> ModuleChannels
+        self.modules = {}
         self.debug = False  # if true - print all received messages
+        # if true - one 'sensors_update' event per frame or batch window
+        self.batch_events = False
+        self.batch_window = None  # seconds to collect changes, per frame
+        self._pending_events = []
+        self._pending_topology = []  # ids of 'topology_update' in batch mode
+        self._pending_since = None
+        self.subscriptions = SubscriptionIndex()
+        # Optional CallbackExecutor running callbacks and subscriptions
+        # off the reader thread, owned and stopped by the caller.
+        self.callback_executor = None
+        # paced, last-write-wins queue of set_value commands
+        self.commands = CommandPipeline(self._sendto)
+        # confirmation of set_value_confirmed commands
+        self.acks = CommandTracker(self.commands)
+        self.commands.on_sent = self.acks.command_sent
         self.persistence = persistence  # if true - save sensors to disk
         self.persistence_file = persistence_file  # path to persistence file
         self.persistence_bak = '{}.bak'.format(self.persistence_file)
+        # save at most every interval seconds or after max changes
+        self.persistence_interval = 1.0
+        self.persistence_max_changes = 100
+        # compact the journal once it holds that many change records
+        self.journal_compact_after = 1000
+        self._journal_records = 0
+        self._changed_ids = set()
+        self._changed_lock = threading.Lock()
+        self._persistence_writer = None
+        self.metrics = None  # Metrics, once enable_metrics was called
+        # SensorHistory, once enable_history was called
+        self.channel_history = None
+        self.last_pong = None  # time.monotonic() of the last PONG
+        self._sessions = 0
+        self._frame_handlers = {
+            StatusFrame: self._handle_status,
+            MaskFrame: self._handle_mask,
+            InfoFrame: self._handle_info,
+            ClockFrame: self._handle_clock,
+            ControlFrame: self._handle_control,
+            UnknownFrame: self._handle_unknown,
+        }
+        # APPINFO topology, {id: (type, desc)}
+        self.topology = {}
+        self.topology_cache = topology_cache  # if true - keep it on disk
+        self.topology_file = '{}.topology'.format(
+            os.path.splitext(self.persistence_file)[0])
+        self._topology_dirty = False
+        self._topology_loaded = False  # true once a cache was read
         if persistence:
             self._safe_load_sensors()
+        if topology_cache:
+            self._load_topology()
+
+    def enable_metrics(self, profile_hook=None):
+        """Start collecting metrics, see stats().
+
+        The optional 'profile_hook' is called with (name, seconds)
+        for every timed section: decode, callback and persistence.
+        """
+        self.metrics = Metrics(profile_hook)
+
+    def disable_metrics(self):
+        """Stop collecting metrics."""
+        self.metrics = None
+
+    def enable_history(self, max_entries=256, max_channels=1024):
+        """Start recording the recent changes of each channel.
+
+        Each channel keeps its last 'max_entries' changes, at most
+        'max_channels' channels are kept, see SensorHistory.
+        """
+        self.channel_history = SensorHistory(max_entries, max_channels)
+
+    def disable_history(self):
+        """Stop recording changes and drop the history."""
+        self.channel_history = None
+
+    def history(self, nid, since=None):
+        """Return the (monotonic time, value) changes of a sensor.
+
+        Only changes after the time.monotonic() 'since' are returned
+        when it is given. Empty when history is not enabled.
+        """
+        if self.channel_history is None:
+            return []
+        return self.channel_history.history(nid, since)
+
+    def last_change(self, nid):
+        """Return the (monotonic time, value) of the last change, or None."""
+        if self.channel_history is None:
+            return None
+        return self.channel_history.last_change(nid)
+
+    def duty_cycle(self, nid, window):
+        """Return the fraction of the last 'window' seconds a sensor was on.
+
+        Returns None without history for that period.
+        """
+        if self.channel_history is None:
+            return None
+        return self.channel_history.duty_cycle(nid, window)
+
+    def _count(self, name, value=1):
+        """Increment a counter when metrics are enabled."""
+        if self.metrics is not None:
+            self.metrics.count(name, value)
+
+    def _count_session(self):
+        """Count a newly opened session."""
+        if self._sessions:
+            self._count('reconnects')
+        self._sessions += 1
+
+    def stats(self):
+        """Return a snapshot of the gateway metrics and state."""
+        if self.metrics is not None:
+            stats = self.metrics.snapshot()
+        else:
+            stats = {'counters': {}, 'gauges': {}, 'histograms': {}}
+        stats['gauges'].update({
+            'sensors': len(self.sensors),
+            'commands_queued': len(self.commands),
+            'commands_unconfirmed': len(self.acks),
+            'pong_age': (time.monotonic() - self.last_pong
+                         if self.last_pong is not None else None),
+        })
+        stats['commands'] = self.commands.stats()
+        stats['acks'] = self.acks.stats()
+        if self.callback_executor is not None:
+            stats['callbacks'] = self.callback_executor.stats()
+        if self.channel_history is not None:
+            stats['history'] = self.channel_history.stats()
+        return stats
 
     def send(self, message):
         """Should be implemented by a child class."""
         raise NotImplementedError
 
+    def _sendto(self, message):
+        """Send a datagram to the gateway, implemented by a child class."""
+        raise NotImplementedError
+
     def logic(self, data):
-        """Parse the data and respond to it appropriately.
+        """Parse a line received from the gateway and apply it.
 
-        Response is returned to the caller and has to be sent
-        data as a command string.
+        Frames needing an answer, like END APPINFO, send it themselves.
         """
-        ret = None
-        try:
-            regex = r"([A-Z0-9]{3}[A-F0-9 ]{6}[IODTCSB]{1}.*\r)"
-            regexClock = r"([0-9]{2}:[0-9 ]{2} [0-9]{2}/[0-9]{2}/[0-9]{2}\r)"
-
-            if data == "PONG\r":
-                pass
-
-            elif re.search(regex, data):
-                data = data[:-1]
-                module = data[:3]
-                serial = data[3:9]
-                type = data[9]
-                value = data[10:]
-
-                if module == "IS8" or module == "IS4" or module == "DET":
-                    if module == "IS8":
-                        num_sensor = 8
-                    elif module == "IS4":
-                        num_sensor = 4
-                    else:
-                        num_sensor = 1
-                    for input in range(1, num_sensor+1):
-                        inputStr = data[:9]
-                        inputStr = inputStr.replace(' ', '0')
-                        inputStr = inputStr + "-" + str(input)
-                        #print(inputStr)
-
-                        if inputStr not in self.sensors:
-                            self.sensors[inputStr] = { "id": inputStr,
-                                                       "type": "input",
-                                                       "desc": "",
-                                                       "value": "" }
-                            print("New sensor: ", inputStr)
-
-                        if int(value, 16) & 1 << (input-1):
-                            newValue = "on"
-                        else:
-                            newValue = "off"
-
-                        if self.sensors[inputStr]["value"] != newValue:
-                            self.sensors[inputStr]["value"] = newValue
-                            self.alert(inputStr)
-
-                elif module == "BU1" or module == "BU2" or \
-                     module == "BU4" or module == "BU6":
-                    num_sensor = int(module[2])
-                    if type == "I":
-                        for input in range(1, num_sensor+1):
-                            inputStr = data[:9]
-                            inputStr = inputStr.replace(' ', '0')
-                            inputStr = inputStr + "-" + str(input)
-                            #print(inputStr)
-
-                            if inputStr not in self.sensors:
-                                self.sensors[inputStr] = { "id": inputStr,
-                                                           "type": "input",
-                                                           "desc": "",
-                                                           "value": "" }
-                                print("New sensor: ", inputStr)
-
-                            if int(value, 16) & 1 << (input-1):
-                                newValue = "on"
-                            else:
-                                newValue = "off"
-
-                            if self.sensors[inputStr]["value"] != newValue:
-                                self.sensors[inputStr]["value"] = newValue
-                                self.alert(inputStr)
-                    else:
-                        for output in range(num_sensor+1, (2*num_sensor)+1):
-                            outputStr = data[:9]
-                            outputStr = outputStr.replace(' ', '0')
-                            outputStr = outputStr + "-" + str(hex(output))[2:].upper()
-                            #print(outputStr)
-
-                            if outputStr not in self.sensors:
-                                self.sensors[outputStr] = { "id": outputStr,
-                                                            "type": "output",
-                                                            "desc": "",
-                                                            "value": "" }
-                                print("New output: ", outputStr)
-
-                            if int(value, 16) & 1 << (output-num_sensor-1):
-                                newValue = "on"
-                            else:
-                                newValue = "off"
-
-                            if self.sensors[outputStr]["value"] != newValue:
-                                self.sensors[outputStr]["value"] = newValue
-                                self.alert(outputStr)
-
-                elif module == "BIR" or module == "DMR":
-                    if module == "BIR":
-                        num_sensor = 8
-                    else:
-                        num_sensor = 5
-
-                    for output in range(1, num_sensor+1):
-                        outputStr = data[:9]
-                        outputStr = outputStr.replace(' ', '0')
-                        outputStr = outputStr + "-" + str(output)
-                        #print(outputStr)
-
-                        if outputStr not in self.sensors:
-                            self.sensors[outputStr] = { "id": outputStr,
-                                                        "type": "output",
-                                                        "desc": "",
-                                                        "value": "" }
-                            print("New output: ", outputStr)
-
-                        if int(value, 16) & 1 << (output-1):
-                            newValue = "on"
-                        else:
-                            newValue = "off"
-
-                        if self.sensors[outputStr]["value"] != newValue:
-                            self.sensors[outputStr]["value"] = newValue
-                            self.alert(outputStr)
-
-                elif module == "DIM":
-                    value = value.replace(' ', '0')
-                    for output in range(1, 9):
-                        outputStr = data[:9]
-                        outputStr = outputStr.replace(' ', '0')
-                        outputStr = outputStr + "-" + str(output)
-
-                        if outputStr not in self.sensors:
-                            self.sensors[outputStr] = { "id": outputStr,
-                                                        "type": "output",
-                                                        "desc": "",
-                                                        "value": "" }
-                            print("New output: ", outputStr)
-
-                        valueStr = value[(output-1)*2:((output-1)*2)+2]
-                        newValue = int(valueStr, 16)
-                        if self.sensors[outputStr]["value"] != newValue:
-                            self.sensors[outputStr]["value"] = newValue
-                            self.alert(outputStr)
-
-                elif module == "AMP":
-                    ampStr = data[:9]
-                    ampStr = ampStr.replace(' ', '0')
-                    ampStr = ampStr + "-" + data[10]
-
-                    if ampStr not in self.sensors:
-                        self.sensors[ampStr] = { "id": ampStr,
-                                                 "type": "ampli",
-                                                 "desc": "",
-                                                 "value": "" }
-                        print("New sensor: ", ampStr)
-
-                    newValue = data[12:]
-
-                    if self.sensors[ampStr]["value"] != newValue:
-                        self.sensors[ampStr]["value"] = newValue
-                        self.alert(ampStr)
-
-                elif module == "VAR" or module == "SYS":
-                    pass
-
-                elif module == "SFE":
-                    #Seems like some of the SFE from APPINFO arrive here
-                    pass
-
-                else:
-                    print("Unknown: ", data)
-                    pass
-
-            elif re.search(regexClock, data):
-                if "clock" not in self.sensors:
-                    self.sensors["clock"] = { "id": "clock",
-                                              "type": "clock",
-                                              "desc": "",
-                                              "value": "" }
-
-                self.sensors["clock"]["value"] = data
-                self.alert("clock")
-
-            elif data.startswith("IS8") or \
-                 data.startswith("IS4") or \
-                 data.startswith("DET"):
-                #print("APPINFO: ", data)
-                data = data[:-1]
-                sensorStr = data[0:11]
-                sensorStr = sensorStr.replace(' ', '0')
-                module = data[:3]
-                value = data[11:].split("[")[0]
-
-                if sensorStr not in self.sensors:
-                    #print("APPINFO: ", data)
-                    self.sensors[sensorStr] = { "id": sensorStr,
-                                                "type": "input",
-                                                "desc": value,
-                                                "value": "" }
-                    #print("Sensor: ", self.sensors[sensorStr])
-                else:
-                    self.sensors[sensorStr]["desc"] = value;
-                    #print("Sensor: ", self.sensors[sensorStr])
-
-            elif data.startswith("BIR") or \
-                 data.startswith("DMR") or \
-                 data.startswith("DIM"):
-                #print("APPINFO: ", data)
-                data = data[:-1]
-                sensorStr = data[0:11]
-                sensorStr = sensorStr.replace(' ', '0')
-                module = data[:3]
-                value = data[11:].split("[")[0]
-
-                if sensorStr not in self.sensors:
-                    #print("APPINFO: ", data)
-                    self.sensors[sensorStr] = { "id": sensorStr,
-                                                "type": "output",
-                                                "desc": value,
-                                                "value": "" }
-                    #print("Sensor: ", self.sensors[sensorStr])
-                else:
-                    self.sensors[sensorStr]["desc"] = value;
-                    #print("Sensor: ", self.sensors[sensorStr])
-
-            elif data.startswith("BU1") or \
-                 data.startswith("BU2") or \
-                 data.startswith("BU4") or \
-                 data.startswith("BU6"):
-                #print("APPINFO: ", data)
-                num_channels = int(data[2])
-                channel = int(data[10], 16)
-                data = data[:-1]
-                sensorStr = data[0:11]
-                sensorStr = sensorStr.replace(' ', '0')
-                module = data[:3]
-                value = data[11:].split("[")[0]
-
-                if channel > num_channels:
-                    type = "output"
-                else:
-                    type = "input"
-
-                if sensorStr not in self.sensors:
-                    #print("APPINFO: ", data)
-                    self.sensors[sensorStr] = { "id": sensorStr,
-                                                "type": type,
-                                                "desc": value,
-                                                "value": "" }
-                    #print("Sensor: ", self.sensors[sensorStr])
-                else:
-                    self.sensors[sensorStr]["desc"] = value;
-                    #print("Sensor: ", self.sensors[sensorStr])
-
-            elif data.startswith("AMP"):
-                #print("APPINFO: ", data)
-                data = data[:-1]
-                sensorStr = data[0:11]
-                sensorStr = sensorStr.replace(' ', '0')
-                module = data[:3]
-                value = data[11:].split("[")[0]
-
-                if sensorStr not in self.sensors:
-                    #print("APPINFO: ", data)
-                    self.sensors[sensorStr] = { "id": sensorStr,
-                                                "type": "ampli",
-                                                "desc": value,
-                                                "value": "" }
-                    #print("Sensor: ", self.sensors[sensorStr])
-                else:
-                    self.sensors[sensorStr]["desc"] = value;
-                    #print("Sensor: ", self.sensors[sensorStr])
-
-            elif data.startswith("END APPINFO"):
-                self.sock.sendto(bytes("PING", 'UTF-8'),
-                                 self.server_address)
-
-            elif data.startswith("STA") or \
-                 data.startswith("APPINFO") or \
-                 data.startswith("SFE") or \
-                 data.startswith("ET2") or \
-                 data.startswith("VAR") or \
-                 data.startswith("SYS") or \
-                 data.startswith("MEM"):
-                pass
-
+        metrics = self.metrics
+        if metrics is None:
+            try:
+                frame = decode(data, masks=True)
+            except ValueError:
+                return
+        else:
+            begin = time.perf_counter()
+            try:
+                frame = decode(data, masks=True)
+            except ValueError:
+                metrics.count('frames_malformed')
+                return
+            metrics.observe('decode', time.perf_counter() - begin)
+            self._count_frame(frame)
+        handler = self._frame_handlers.get(type(frame))
+        if handler is None:
+            return
+        handler(frame)
+        if self._unpublished:
+            self._publish()
+        if self._pending_events:
+            self.flush_events()
+
+    def logic_many(self, lines):
+        """Apply a block of received lines, as logic on each would.
+
+        The block is decoded in one pass and its changes are published
+        as a single generation. When nothing consumes changes (no
+        callback, subscription, batch or history at the start of the
+        block, no command waiting for confirmation at each frame),
+        mask frames update the sensors without going through alert.
+        """
+        if self.metrics is not None:
+            for data in lines:
+                self.logic(data)
+            return
+        frames = decode_block(lines)
+        handlers = self._frame_handlers
+        modules = self.modules
+        unpublished = self._unpublished
+        # other threads add confirmed commands at any time, acks is
+        # checked for each frame
+        acks = self.acks
+        quiet = not (self.subscriptions or self.batch_events or
+                     self.event_callback is not None or
+                     self.channel_history is not None)
+        for frame in frames:
+            if frame is None:
+                continue
+            frame_type = type(frame)
+            if frame_type is not MaskFrame or not quiet or acks:
+                handler = handlers.get(frame_type)
+                if handler is not None:
+                    handler(frame)
+                    if self._pending_events:
+                        self.flush_events()
+                continue
+            key = (frame.key, frame.bank)
+            module = modules.get(key)
+            if module is None:
+                module = modules[key] = self._index_module(frame)
+                changed = None
             else:
-                print("Unknown: ", data)
-
-        except ValueError:
+                changed = frame.mask ^ module.mask
+                if not changed:
+                    continue
+            module.mask = frame.mask
+            sensors = module.sensors
+            for index, value in frame.module_type.channel_values(
+                    frame.mask, changed):
+                sensor = sensors[index]
+                if sensor.value != value:
+                    sensor.value = value
+                    unpublished.append(sensor.id)
+        if self._unpublished:
+            self._publish()
+
+    def _count_frame(self, frame):
+        """Count a decoded frame per module type or frame kind."""
+        frame_type = type(frame)
+        if frame_type is MaskFrame:
+            name = frame.key[:3]
+        elif frame_type is StatusFrame:
+            name = frame.module
+        else:
+            name = FRAME_KINDS.get(frame_type, 'other')
+        self.metrics.count('frames_' + name)
+
+    def _get_sensor(self, nid, sensor_type, announce=True):
+        """Return a sensor, creating it if needed."""
+        sensor = self.sensors.get(nid)
+        if sensor is None:
+            sensor = Sensor(nid, sensor_type)
+            self.sensors[sensor.id] = sensor
+            self._unpublished.append(sensor.id)
+            if announce:
+                if sensor.type is SensorType.OUTPUT:
+                    print("New output: ", nid)
+                else:
+                    print("New sensor: ", nid)
+        return sensor
+
+    def _update_sensor(self, nid, sensor_type, value):
+        """Create the sensor if needed and alert when its value changed."""
+        sensor = self._get_sensor(nid, sensor_type)
+        old = sensor.value
+        if old != value:
+            sensor.value = value
+            self.alert(nid, old)
+
+    def _index_module(self, frame):
+        """Build the channel index of a module bank on first sight."""
+        return ModuleChannels(tuple(
+            self._get_sensor(frame.key + suffix, sensor_type)
+            for suffix, sensor_type in frame.module_type.bank_channels(
+                frame.bank)))
+
+    def _handle_mask(self, frame):
+        """Apply only the channels whose bits changed since last frame."""
+        key = (frame.key, frame.bank)
+        module = self.modules.get(key)
+        if module is None:
+            module = self.modules[key] = self._index_module(frame)
+            changed = None
+        else:
+            changed = frame.mask ^ module.mask
+            if not changed:
+                return
+        module.mask = frame.mask
+        sensors = module.sensors
+        for index, value in frame.module_type.channel_values(frame.mask,
+                                                             changed):
+            sensor = sensors[index]
+            old = sensor.value
+            if old != value:
+                sensor.value = value
+                self.alert(sensor.id, old)
+
+    def _handle_status(self, frame):
+        """Apply the channels of a status frame."""
+        for channel in frame.channels:
+            self._update_sensor(channel.id, channel.type, channel.value)
+
+    def _handle_info(self, frame):
+        """Store the APPINFO description of a channel.
+
+        Only entries differing from the known topology are applied.
+        When a cached topology was loaded, each of them is reported
+        with a 'topology_update' event, queued for flush_events in
+        batch mode.
+        """
+        entry = (frame.type, frame.desc)
+        if self.topology.get(frame.id) == entry:
+            return
+        self.topology[frame.id] = entry
+        self._topology_dirty = True
+        sensor = self._get_sensor(frame.id, frame.type, announce=False)
+        sensor.type = SensorType(frame.type)
+        sensor.desc = frame.desc
+        self._unpublished.append(sensor.id)
+        if not self._topology_loaded:
+            return
+        if self.batch_events:
+            if not self._pending_events and not self._pending_topology:
+                self._pending_since = time.monotonic()
+            self._pending_topology.append(sensor.id)
+        elif self.event_callback is not None:
+            self._callback('topology_update', sensor.id)
+
+    def _load_topology(self):
+        """Create the sensors of the cached topology."""
+        from .persistence import load_topology
+        topology = load_topology(self.topology_file)
+        if topology is None:
+            return
+        for nid, (sensor_type, desc) in topology.items():
+            self._get_sensor(nid, sensor_type, announce=False).desc = desc
+        self.topology = topology
+        self._topology_loaded = True
+        self._reset_states()
+
+    def _save_topology(self):
+        """Write the topology cache if APPINFO changed it."""
+        if not self._topology_dirty:
+            return
+        from .persistence import save_topology
+        try:
+            save_topology(self.topology_file, dict(self.topology))
+        except OSError:
+            _LOGGER.error('Cannot write topology cache %s',
+                          self.topology_file)
             return
+        self._topology_dirty = False
+
+    def _handle_clock(self, frame):
+        """Update the clock pseudo sensor."""
+        if "clock" not in self.sensors:
+            self.sensors["clock"] = Sensor("clock", SensorType.CLOCK)
+        clock = self.sensors["clock"]
+        old, clock.value = clock.value, frame.value
+        self.alert("clock", old)
+
+    def _handle_control(self, frame):
+        """Keep the session alive once discovery is done."""
+        if frame.command == "PONG":
+            self.last_pong = time.monotonic()
+        elif frame.command == "END APPINFO":
+            self._sendto("PING")
+            if self.topology_cache:
+                self._save_topology()
+            if self._pending_topology:
+                self.flush_events(force=True)
+
+    def _handle_unknown(self, frame):
+        """Report lines the decoder does not understand."""
+        # pylint: disable=no-self-use
+        print("Unknown: ", frame.data)
+
+    def _saved_sensors(self):
+        """Return the saved states of the last published generation.
+
+        The reader thread keeps changing the live sensors while this
+        runs on the save timer, the generation does not change.
+        """
+        return {nid: saved_state(state)
+                for nid, state in self._generation.items()}
 
     def _save_pickle(self, filename):
         """Save sensors to pickle file."""
+        import pickle
         with open(filename, 'wb') as file_handle:
-            pickle.dump(self.sensors, file_handle, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(self._saved_sensors(), file_handle,
+                        pickle.HIGHEST_PROTOCOL)
             file_handle.flush()
             os.fsync(file_handle.fileno())
 
     def _load_pickle(self, filename):
         """Load sensors from pickle file."""
+        import pickle
+        with open(filename, 'rb') as file_handle:
+            self.sensors = upgrade_sensors(pickle.load(file_handle))
+        self.modules = {}
+        self._reset_states()
+
+    def _save_journal(self, filename):
+        """Save sensors as a journal holding a single snapshot."""
+        from .persistence import JOURNAL_SNAPSHOT, write_journal_record
+        with open(filename, 'wb') as file_handle:
+            write_journal_record(file_handle,
+                                 (JOURNAL_SNAPSHOT, self._saved_sensors()))
+            file_handle.flush()
+            os.fsync(file_handle.fileno())
+        self._journal_records = 0
+
+    def _append_journal(self, filename):
+        """Append the changed sensors to the journal."""
+        from .persistence import JOURNAL_CHANGE, write_journal_record
+        with self._changed_lock:
+            changed, self._changed_ids = self._changed_ids, set()
+        generation = self._generation
+        with open(filename, 'ab') as file_handle:
+            for nid in changed:
+                state = generation.get(nid)
+                if state is not None:
+                    write_journal_record(
+                        file_handle, (JOURNAL_CHANGE, nid, saved_state(state)))
+            file_handle.flush()
+            os.fsync(file_handle.fileno())
+        self._journal_records += len(changed)
+
+    def _load_journal(self, filename):
+        """Load sensors from the journal snapshot and replay changes.
+
+        A truncated last record is cut off so appending can resume.
+        """
+        from .persistence import (JOURNAL_CHANGE, JOURNAL_SNAPSHOT,
+                                  read_journal_records)
+        sensors = None
+        valid = 0
         with open(filename, 'rb') as file_handle:
-            self.sensors = pickle.load(file_handle)
+            for record, valid in read_journal_records(file_handle):
+                if record[0] == JOURNAL_SNAPSHOT:
+                    sensors = record[1]
+                    self._journal_records = 0
+                elif sensors is not None and record[0] == JOURNAL_CHANGE:
+                    sensors[record[1]] = record[2]
+                    self._journal_records += 1
+        if sensors is None:
+            raise ValueError('Journal has no snapshot: %s' % filename)
+        if valid < os.path.getsize(filename):
+            _LOGGER.warning('Dropping truncated record from %s', filename)
+            with open(filename, 'r+b') as file_handle:
+                file_handle.truncate(valid)
+        self.sensors = upgrade_sensors(sensors)
+        self.modules = {}
+        self._reset_states()
+
+    def _flush_sensors(self):
+        """Write pending changes to file.
+
+        File types with an append action only get the changes, until
+        enough accumulated to compact them into a new snapshot.
+        """
+        metrics = self.metrics
+        if metrics is None:
+            self._write_sensors()
+            return
+        begin = time.perf_counter()
+        self._write_sensors()
+        metrics.observe('persistence', time.perf_counter() - begin)
+
+    def _write_sensors(self):
+        """Append or save the sensors, depending on the file type."""
+        fname = os.path.realpath(self.persistence_file)
+        ext = os.path.splitext(fname)[1]
+        if getattr(self, '_append_%s' % ext[1:], None) is None or \
+           not os.path.isfile(fname) or \
+           self._journal_records >= self.journal_compact_after:
+            with self._changed_lock:
+                self._changed_ids = set()
+            self._save_sensors()
+        elif os.access(fname, os.W_OK):
+            self._perform_file_action(fname, 'append')
+        else:
+            _LOGGER.error('Permission denied when writing to %s', fname)
 
     def _save_sensors(self):
         """Save sensors to file."""
@@ -362,6 +565,22 @@ class Gateway(object):
         else:
             _LOGGER.error('Permission denied when writing to %s', fname)
 
+    def _save_sensors_later(self):
+        """Have the persistence writer save the sensors soon."""
+        if self._persistence_writer is None:
+            from .persistence import PersistenceWriter
+            self._persistence_writer = PersistenceWriter(
+                self._flush_sensors, self.persistence_interval,
+                self.persistence_max_changes)
+            self._persistence_writer.start()
+        self._persistence_writer.notify()
+
+    def _stop_persistence(self):
+        """Save pending changes and stop the persistence writer."""
+        writer, self._persistence_writer = self._persistence_writer, None
+        if writer is not None:
+            writer.stop()
+
     def _load_sensors(self, path=None):
         """Load sensors from file."""
         if path is None:
@@ -407,19 +626,176 @@ class Gateway(object):
             raise Exception('Unsupported file type %s' % ext[1:])
         func(filename)
 
-    def alert(self, nid):
+    def alert(self, nid, old=None):
         """Tell anyone who wants to know that a sensor was updated.
 
-        Also save sensors if persistence is enabled.
+        In batch mode the change is queued for flush_events instead.
+        The new state is published, and saved if persistence is
+        enabled, once the frame is applied.
         """
-        if self.event_callback is not None:
-            try:
-                self.event_callback('sensor_update', nid)
-            except Exception as exception:  # pylint: disable=W0703
-                _LOGGER.exception(exception)
+        self._unpublished.append(nid)
+        if self.channel_history is not None:
+            self.channel_history.record(nid, self.sensors[nid].value)
+        if self.acks:
+            self.acks.confirm(nid, self.sensors[nid].value)
+        if self.subscriptions:
+            sensor = self.sensors[nid]
+            if self.callback_executor is not None:
+                self.callback_executor.submit(
+                    ('subscriptions', nid), self.subscriptions.dispatch,
+                    sensor, old, sensor.value, merge=_merge_changes)
+            else:
+                self.subscriptions.dispatch(sensor, old, sensor.value)
+        if self.batch_events:
+            if not self._pending_events and not self._pending_topology:
+                self._pending_since = time.monotonic()
+            self._pending_events.append((nid, old, self.sensors[nid].value))
+        elif self.event_callback is not None:
+            self._callback('sensor_update', nid)
+
+    def subscribe(self, callback, nid=None, prefix=None, sensor_type=None,
+                  predicate=None):
+        """Call 'callback' with (id, old, new) for matching changes.
+
+        Filters are combined: 'nid' is a sensor id, 'prefix' a module
+        code ("IS8"), serial ("0012AB") or module id ("IS80012AB"),
+        'sensor_type' one of input/output/ampli/clock and 'predicate'
+        a function of the new value. Returns the subscription to pass
+        to unsubscribe.
+        """
+        # pylint: disable=too-many-arguments
+        return self.subscriptions.add(Subscription(
+            callback, nid, prefix, sensor_type, predicate))
+
+    def unsubscribe(self, subscription):
+        """Remove a subscription."""
+        self.subscriptions.remove(subscription)
 
+    @property
+    def version(self):
+        """Version of the last published generation."""
+        return self._generation.version
+
+    def _publish(self):
+        """Publish the states changed since the last publish.
+
+        Only the reader thread calls this. The new generation is
+        published with a single reference assignment, readers never
+        see it half built.
+        """
+        changed = set(self._unpublished)
+        self._unpublished = []
+        generation = self._generation.evolve(self.sensors, changed)
+        nodes = self._change_nodes
+        nodes.append(generation.changes)
+        if len(nodes) > CHANGE_LOG_SIZE:
+            nodes.popleft()
+            nodes[0].previous = None
+        self._generation = generation
         if self.persistence:
-            self._save_sensors()
+            with self._changed_lock:
+                self._changed_ids.update(changed)
+            self._save_sensors_later()
+
+    def _reset_states(self):
+        """Publish a new generation after the sensors were replaced."""
+        self._unpublished = []
+        generation = Generation.from_sensors(self._generation.version + 1,
+                                             self.sensors)
+        self._change_nodes = deque([generation.changes])
+        self._generation = generation
+
+    def snapshot(self):
+        """Return a consistent, read-only view of all sensor states.
+
+        The view is the immutable generation published after the
+        last applied line or block, taking it costs an attribute read.
+        Any thread may call.
+        """
+        generation = self._generation
+        return Snapshot(generation.version, generation)
+
+    def get_many(self, ids):
+        """Return a consistent view of the states of the given ids.
+
+        Unknown ids are left out.
+        """
+        generation = self._generation
+        return Snapshot(generation.version, MappingProxyType(
+            {nid: generation[nid] for nid in ids if nid in generation}))
+
+    def changes_since(self, version):
+        """Return the current states of the sensors changed after 'version'.
+
+        Pollers pass the version of their last snapshot or changes.
+        When the change chain no longer reaches back to 'version',
+        all states are returned with 'reset' set.
+        """
+        generation = self._generation
+        changed = set()
+        node = generation.changes
+        while node.version > version:
+            changed.update(node.ids)
+            previous = node.previous
+            if previous is None:
+                if node.previous_version > version:
+                    return Changes(generation.version, generation, True)
+                break
+            node = previous
+        return Changes(generation.version, MappingProxyType(
+            {nid: generation[nid] for nid in changed}), False)
+
+    def flush_events(self, force=False):
+        """Deliver the queued changes in a single 'sensors_update' event.
+
+        The callback gets a list of (id, old, new). Queued topology
+        changes go first, as one 'topology_update' event with a list
+        of ids. With a batch window, changes are held until the window
+        expired unless 'force' is True.
+        """
+        if not self._pending_events and not self._pending_topology:
+            return
+        if not force and self.batch_window and \
+           time.monotonic() - self._pending_since < self.batch_window:
+            return
+        topology, self._pending_topology = self._pending_topology, []
+        events, self._pending_events = self._pending_events, []
+        if self.event_callback is None:
+            return
+        if topology:
+            self._callback('topology_update', topology)
+        if events:
+            self._callback('sensors_update', events)
+
+    def _callback(self, update_type, data):
+        """Call the event callback, on the callback executor if any.
+
+        Events of the same sensor id, or of the same update type for
+        batches, keep their order on the executor.
+        """
+        executor = self.callback_executor
+        if executor is None:
+            self._run_callback(update_type, data)
+            return
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.gauge('callbacks_pending', len(executor))
+        executor.submit(data if isinstance(data, str) else update_type,
+                        self._run_callback, update_type, data,
+                        time.perf_counter(), merge=_merge_events)
+
+    def _run_callback(self, update_type, data, queued=None):
+        """Call the event callback, timing it when metrics are enabled."""
+        metrics = self.metrics
+        begin = time.perf_counter() if metrics is not None else None
+        if queued is not None and metrics is not None:
+            metrics.observe('callback_lag', begin - queued)
+        try:
+            self.event_callback(update_type, data)
+        except Exception as exception:  # pylint: disable=W0703
+            _LOGGER.exception(exception)
+        if metrics is not None:
+            metrics.observe('callback', time.perf_counter() - begin)
 
     def handle_queue(self, queue=None):
         """Handle queue.
@@ -449,190 +825,131 @@ class Gateway(object):
             queue = self.queue
         queue.put((func, args, kwargs))
 
-    def set_value(self, sensor_id, child_id, value_type, value, **kwargs):
-        if sensor_id not in self.sensors:
-            return
+    def _output_command(self, sensor_id, value):
+        """Return (command, expected value) switching an output on or off.
 
-        if self.sensors[sensor_id]["type"] != "output":
-            return
+        Like the original set_value, 1 and "on" switch on and any
+        other value switches off, DIM channels included. Returns None
+        if the sensor is not an output.
+        """
+        sensor = self._generation.get(sensor_id)
+        if sensor is None or sensor.type is not SensorType.OUTPUT:
+            return None
+        return output_command(sensor, "on" if value == 1 or value == "on"
+                              else "off")
 
-        if sensor_id.startswith("BU"):
-            num_channels = int(sensor_id[2])
-            channel = int(sensor_id[10], 16)
-            if channel > num_channels:
-                sensor_id = sensor_id[0:10] + str(channel - num_channels)
+    def set_value(self, sensor_id, child_id, value_type, value, **kwargs):
+        """Queue a command switching an output on or off.
 
-        if value == 1 or value == "on":
-             command = sensor_id + "%I"
+        Return the command string, which is sent by the transport at
+        the pace of the command pipeline.
+        """
+        command = self._output_command(sensor_id, value)
+        if command is None:
+            return None
+        self.commands.submit(sensor_id, command[0])
+        return command[0]
+
+    def set_value_confirmed(self, sensor_id, child_id, value_type, value,
+                            **kwargs):
+        """Switch an output and return a future for the confirmation.
+
+        The future resolves to True once a status frame shows the new
+        state, to False when a newer command to the output supersedes
+        it, and fails with TimeoutError when retransmissions did not
+        help. Commands whose state cannot be confirmed (DIM on / off)
+        resolve to True once submitted. Returns None if the sensor is
+        not an output.
+        """
+        command = self._output_command(sensor_id, value)
+        if command is None:
+            return None
+        command, expected = command
+        if expected is None:
+            future = Future()
+            future.set_running_or_notify_cancel()
+            future.set_result(True)
+            self.commands.submit(sensor_id, command)
+            return future
+        future = self.acks.track(sensor_id, expected, command)
+        if self._generation[sensor_id].value == expected:
+            self.acks.confirm(sensor_id, expected)
         else:
-             command = sensor_id + "%O"
-        
-        self.sock.sendto(bytes(command, 'UTF-8'), self.server_address)
-        return command
-
-class Deth01Gateway(Gateway, threading.Thread):
-    """Domintell UDP ethernet gateway."""
-
-    # pylint: disable=too-many-arguments
-
-    def __init__(self, host, event_callback=None,
-                 persistence=False, persistence_file='domintell.pickle',
-                 port=17481, timeout=1.0,
-                 reconnect_timeout=10.0):
-        """Setup UDP ethernet gateway."""
-        threading.Thread.__init__(self)
-        Gateway.__init__(self, event_callback, persistence,
-                         persistence_file)
-        self.sock = None
-        self.server_address = (host, port)
-        self.timeout = timeout
-        self.reconnect_timeout = reconnect_timeout
-        self._stop_event = threading.Event()
-
-    def connect(self):
-        """Connect to the Domintell system, on host and port."""
-        if self.sock == None:
-            self.sock = socket.socket(socket.AF_INET, # Internet
-                                      socket.SOCK_DGRAM) # UDP
-            self.sock.setsockopt(socket.SOL_SOCKET,
-                                 socket.SO_REUSEADDR,
-                                 1)
-
-        self.sock.sendto(bytes("LOGIN", 'UTF-8'), self.server_address)
-        time.sleep(0.02)  # short sleep to avoid burning 100% cpu
-        try:
-            available_socks = self._check_socket()
-        except OSError:
-            print('Server socket %s has an error.', self.sock)
-            self.disconnect()
-            return False
-        if available_socks[0] and self.sock is not None:
-            string = self.recv_timeout()
-            line = string.rstrip()
-            if line == "INFO:Session opened:INFO":
-                print(line)
-                self.sock.sendto(bytes("APPINFO", 'UTF-8'),
-                                 self.server_address)
-                return True
-
-        self.disconnect()
-        return False
-
-    def disconnect(self):
-        """Close the socket."""
-        if not self.sock:
-            return
-        _LOGGER.info('Closing socket at %s.', self.server_address)
-        #self.sock.shutdown(socket.SHUT_WR)
-        self.sock.close()
-        self.sock = None
-        _LOGGER.info('Socket closed at %s.', self.server_address)
-
-    def stop(self):
-        """Stop the background thread."""
-        _LOGGER.info('Stopping thread')
-        self._stop_event.set()
-
-    def _check_socket(self, sock=None, timeout=None):
-        """Check if socket is readable/writable."""
-        if sock is None:
-            sock = self.sock
-        available_socks = select.select([sock], [sock], [sock], timeout)
-        if available_socks[2]:
-            raise OSError
-        return available_socks
-
-    def recv_timeout(self):
-        """Receive reply from server, with a timeout."""
-        # make socket non blocking
-        self.sock.setblocking(False)
-        # total data in an array
-        total_data = []
-        data_string = ''
-        joined_data = ''
-        # start time
-        begin = time.time()
-
-        while not data_string.endswith('\n'):
-            data_string = ''
-            # break after timeout
-            if time.time() - begin > self.timeout:
-                break
-            # receive data
-            try:
-                data_bytes = self.sock.recv(1024)
-                if data_bytes:
-                    data_string = data_bytes.decode('utf-8')
-                    _LOGGER.debug('Received %s', data_string)
-                    total_data.append(data_string)
-                    # reset start time
-                    begin = time.time()
-                    # join all data to final data
-                    joined_data = ''.join(total_data)
-                else:
-                    # sleep to add time difference
-                    time.sleep(0.1)
-            except OSError:
-                _LOGGER.error('Receive from server failed.')
-                self.disconnect()
-                break
-            except ValueError:
-                _LOGGER.warning(
-                    'Error decoding message from gateway, '
-                    'probably received bad byte.')
-                break
+            self.commands.submit(sensor_id, command)
+        return future
 
-        return joined_data
+    def scene(self, values):
+        """Validate {id: value} and return its commands as a Scene.
 
-    def send(self, message):
-        """Write a command string to the gateway via the socket."""
-        if not message:
-            return
-        with self.lock:
-            try:
-                # Send data
-                _LOGGER.debug('Sending %s', message)
-                self.sock.sendall(message.encode())
-
-            except OSError:
-                # Send failed
-                _LOGGER.error('Send to server failed.')
-                self.disconnect()
-
-    def run(self):
-        """Background thread that reads messages from the gateway."""
-        self.lastKeepalive = 0;
-
-        while not self._stop_event.is_set():
-            if self.sock is None and not self.connect():
-                print('Waiting %s secs before trying to connect again.', self.reconnect_timeout)
-                time.sleep(self.reconnect_timeout)
+        Values are those of output_command: on / off for outputs,
+        levels for DIM channels and volumes for AMP channels. Raises
+        ValueError for unknown sensors or bad values.
+        """
+        commands = []
+        states = self._generation
+        for nid, value in values.items():
+            sensor = states.get(nid)
+            if sensor is None:
+                raise ValueError('Unknown sensor: %s' % nid)
+            command, expected = output_command(sensor, value)
+            commands.append((sensor.id, command, expected))
+        # channels of a module go out back to back
+        commands.sort()
+        return Scene(tuple(commands))
+
+    def run_scene(self, scene):
+        """Send the commands of a scene and return a future for them all.
+
+        Outputs already in their target state are not sent. The
+        future resolves to {id: result}: True once confirmed or when
+        the state cannot be confirmed (DIM on / off), False when
+        superseded or unconfirmed after the retransmissions.
+        """
+        futures = {}
+        submit = []
+        states = self._generation
+        for nid, command, expected in scene.commands:
+            if expected is None:
+                future = futures[nid] = Future()
+                future.set_running_or_notify_cancel()
+                future.set_result(True)
+                submit.append((nid, command))
                 continue
+            futures[nid] = self.acks.track(nid, expected, command)
+            state = states.get(nid)
+            if state is not None and state.value == expected:
+                self.acks.confirm(nid, expected)
+            else:
+                submit.append((nid, command))
+        self.commands.submit_many(submit)
+        return gather(futures)
 
-            if self.lastKeepalive == 0 or time.time() - self.lastKeepalive > 60:
-                self.sock.sendto(bytes("PING", 'UTF-8'),
-                                 self.server_address)
-                self.lastKeepalive = time.time();
- 
-            try:
-                available_socks = self._check_socket()
-            except OSError:
-                print('Server socket %s has an error.', self.sock)
-                self.disconnect()
-                continue
-            if available_socks[1] and self.sock is not None:
-                response = self.handle_queue()
-                if response is not None:
-                    self.send(response)
-            if not self.queue.empty():
-                continue
-            time.sleep(0.02)  # short sleep to avoid burning 100% cpu
-            if available_socks[0] and self.sock is not None:
-                string = self.recv_timeout()
-                lines = string.split('\n')
-                #print(lines)
-                # Throw away last empty line or uncompleted message.
-                del lines[-1]
-                for line in lines:
-                    self.fill_queue(self.logic, (line,))
-        self.disconnect()
+    def set_values(self, values):
+        """Set many outputs in one operation, see scene and run_scene."""
+        return self.run_scene(self.scene(values))
+
+
+def _merge_events(pending, new):
+    """Combine the _run_callback args of two events of the same key.
+
+    Batches are concatenated, a single-id event replaces a pending
+    one of the same type. Events of different types are not merged.
+    """
+    if pending[0] != new[0]:
+        return None
+    if isinstance(new[1], list):
+        return (new[0], pending[1] + new[1], pending[2])
+    return (new[0], new[1], pending[2])
+
+
+def _merge_changes(pending, new):
+    """Combine two (sensor, old, new) changes into one."""
+    return (new[0], pending[1], new[2])
+
+
+def __getattr__(name):
+    """Import Deth01Gateway, now in deth01, on first access."""
+    if name == 'Deth01Gateway':
+        from .deth01 import Deth01Gateway
+        return Deth01Gateway
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
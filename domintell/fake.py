@@ -0,0 +1,123 @@
+"""Local stand-in for a Domintell DETH01 gateway, for tests and benchmarks."""
+import logging
+import socket
+import threading
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def load_capture(path):
+    """Return the frames of a capture file, one frame per line.
+
+    Frames are returned with the trailing '\\r' the gateway sends.
+    Empty lines and lines starting with '#' are skipped, as are the
+    timestamps of domintell.offline captures.
+    """
+    frames = []
+    with open(path, encoding='utf-8') as file_handle:
+        for line in file_handle:
+            line = line.rstrip('\r\n')
+            if line and not line.startswith('#'):
+                frames.append(line.rpartition('\t')[2] + '\r')
+    return frames
+
+
+class FakeDeth01Server(threading.Thread):
+    """UDP server speaking the DETH01 session protocol.
+
+    Answers LOGIN, APPINFO and PING like a DETH01, switches the
+    outputs of mask modules on %I / %O commands, sets DIM levels on
+    %D and AMP volumes on %V, replying with their status frame.
+    Frames can be pushed or replayed to the client.
+    """
+
+    def __init__(self, appinfo=(), host='127.0.0.1', port=0):
+        """Setup server answering APPINFO with the 'appinfo' lines."""
+        threading.Thread.__init__(self, name='fake-deth01')
+        self.daemon = True
+        self.appinfo = list(appinfo)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.settimeout(0.1)
+        self.address = self.sock.getsockname()
+        self.client = None
+        self.outputs = {}  # module id -> output bitmask
+        self.levels = {}  # DIM module id -> channel levels
+        self.received = []  # commands other than the session ones
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        """Stop the server and close its socket."""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        self.sock.close()
+
+    def send_lines(self, lines):
+        """Send frames to the client, in a single datagram."""
+        if self.client is None:
+            return
+        data = ''.join(line.rstrip('\r') + '\r\n' for line in lines)
+        self.sock.sendto(data.encode('utf-8'), self.client)
+
+    def replay(self, frames, rate=None, batch=1):
+        """Send frames to the client, 'batch' frames per datagram.
+
+        With a rate, datagrams are paced at 'rate' frames per second.
+        """
+        interval = batch / rate if rate else 0.0
+        next_send = time.monotonic()
+        for start in range(0, len(frames), batch):
+            if interval:
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_send += interval
+            self.send_lines(frames[start:start + batch])
+
+    def handle(self, message):
+        """Answer a datagram received from the client."""
+        if message == "LOGIN":
+            self.send_lines(["INFO:Session opened:INFO"])
+        elif message == "APPINFO":
+            self.send_lines(["APPINFO"] + self.appinfo + ["END APPINFO"])
+        elif message == "PING":
+            self.send_lines(["PONG"])
+        elif message.endswith(("%I", "%O")):
+            self.received.append(message)
+            module = message[:9]
+            channel = int(message[10:-2], 16)
+            mask = self.outputs.get(module, 0)
+            if message.endswith("%I"):
+                mask |= 1 << (channel - 1)
+            else:
+                mask &= ~(1 << (channel - 1))
+            self.outputs[module] = mask
+            self.send_lines(["%sO%02X" % (module, mask)])
+        elif "%D" in message:
+            self.received.append(message)
+            module = message[:9]
+            target, level = message.split("%D")
+            levels = self.levels.setdefault(module, [0] * 8)
+            levels[int(target[10:], 16) - 1] = int(level)
+            self.send_lines([module + "D" +
+                             ''.join('%02X' % level for level in levels)])
+        elif "%V" in message:
+            self.received.append(message)
+            target, volume = message.split("%V")
+            self.send_lines(["%sO%s %s" % (target[:9], target[10:], volume)])
+        else:
+            self.received.append(message)
+
+    def run(self):
+        """Serve until stopped."""
+        while not self._stop_event.is_set():
+            try:
+                data, address = self.sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            self.client = address
+            self.handle(data.decode('utf-8'))
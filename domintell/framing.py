@@ -0,0 +1,66 @@
+"""Split the bytes received from a gateway into lines."""
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class LineFramer(object):
+    """Split received bytes into lines, across datagram boundaries.
+
+    Complete lines are decoded once, straight from the receive
+    buffer. Only an uncompleted last line is copied, and kept until
+    the datagram completing it arrives.
+    """
+
+    def __init__(self, max_line=4096):
+        self.max_line = max_line
+        self._partial = bytearray()
+        self._dropping = False  # skipping the rest of an overlong line
+
+    def reset(self):
+        """Forget the uncompleted line, e.g. on a new session."""
+        self._partial.clear()
+        self._dropping = False
+
+    def feed(self, data, size=None):
+        """Yield the completed lines of the first 'size' bytes of 'data'.
+
+        Lines are returned as str without the '\\n'. Lines that are
+        not valid UTF-8 are logged and skipped. An uncompleted line
+        growing over 'max_line' bytes is dropped up to its '\\n'.
+        """
+        if size is None:
+            size = len(data)
+        view = memoryview(data)
+        partial = self._partial
+        start = 0
+        if self._dropping:
+            end = data.find(b'\n', 0, size)
+            if end < 0:
+                return
+            self._dropping = False
+            start = end + 1
+        while start < size:
+            end = data.find(b'\n', start, size)
+            if end < 0:
+                if len(partial) + size - start > self.max_line:
+                    _LOGGER.warning('Dropping overlong line from gateway')
+                    partial.clear()
+                    self._dropping = True
+                else:
+                    partial += view[start:size]
+                return
+            try:
+                if partial:
+                    partial += view[start:end]
+                    line = partial.decode('utf-8')
+                else:
+                    line = str(view[start:end], 'utf-8')
+            except ValueError:
+                _LOGGER.warning(
+                    'Error decoding message from gateway, '
+                    'probably received bad byte.')
+            else:
+                yield line
+            partial.clear()
+            start = end + 1
@@ -0,0 +1,182 @@
+"""Bounded per-channel history of sensor values."""
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+
+def is_on(value):
+    """Return True for values counted as active by duty_cycle."""
+    if value == "on":
+        return True
+    return isinstance(value, int) and value > 0
+
+
+class ChannelHistory(object):
+    """Ring buffer of the last (monotonic time, value) of a channel.
+
+    Next to each entry, the time the channel was on since its first
+    entry is kept, so windowed queries are two binary searches.
+    """
+
+    __slots__ = ('capacity', 'times', 'values', 'on_times', 'start',
+                 'count')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.on_times = array('d', bytes(8 * capacity))
+        self.values = [None] * capacity
+        self.start = 0  # slot of the oldest entry
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _slot(self, index):
+        """Return the slot of the index-th oldest entry."""
+        return (self.start + index) % self.capacity
+
+    def append(self, when, value):
+        """Add an entry, evicting the oldest one when full."""
+        capacity = self.capacity
+        if self.count:
+            last = (self.start + self.count - 1) % capacity
+            on_time = self.on_times[last]
+            if is_on(self.values[last]):
+                on_time += when - self.times[last]
+        else:
+            on_time = 0.0
+        if self.count < capacity:
+            slot = (self.start + self.count) % capacity
+            self.count += 1
+        else:
+            slot = self.start
+            self.start = (self.start + 1) % capacity
+        self.times[slot] = when
+        self.values[slot] = value
+        self.on_times[slot] = on_time
+
+    def last(self):
+        """Return the newest (time, value), None when empty."""
+        if not self.count:
+            return None
+        slot = self._slot(self.count - 1)
+        return self.times[slot], self.values[slot]
+
+    def oldest_time(self):
+        """Return the time of the oldest entry, None when empty."""
+        return self.times[self.start] if self.count else None
+
+    def bisect(self, when):
+        """Return the number of entries at or before 'when'."""
+        low, high = 0, self.count
+        times = self.times
+        while low < high:
+            middle = (low + high) // 2
+            if times[self._slot(middle)] <= when:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def since(self, when):
+        """Return the (time, value) entries after 'when', oldest first."""
+        entries = []
+        for index in range(self.bisect(when), self.count):
+            slot = self._slot(index)
+            entries.append((self.times[slot], self.values[slot]))
+        return entries
+
+    def on_time_until(self, when):
+        """Return the on time between the oldest entry and 'when'."""
+        index = self.bisect(when) - 1
+        if index < 0:
+            return 0.0
+        slot = self._slot(index)
+        on_time = self.on_times[slot]
+        if is_on(self.values[slot]):
+            on_time += when - self.times[slot]
+        return on_time
+
+
+class SensorHistory(object):
+    """Histories of the channels of a gateway, with a memory cap.
+
+    Each channel keeps its last 'max_entries' changes. Once more than
+    'max_channels' channels have a history, the channel that changed
+    least recently loses its history. Any thread may query while the
+    reader thread records.
+    """
+
+    def __init__(self, max_entries=256, max_channels=1024):
+        self.max_entries = max_entries
+        self.max_channels = max_channels
+        self._channels = OrderedDict()  # id -> ChannelHistory, LRU first
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._channels)
+
+    def record(self, nid, value, when=None):
+        """Record the new value of a channel."""
+        if when is None:
+            when = time.monotonic()
+        channels = self._channels
+        with self._lock:
+            channel = channels.get(nid)
+            if channel is None:
+                channel = channels[nid] = ChannelHistory(self.max_entries)
+                if len(channels) > self.max_channels:
+                    channels.popitem(last=False)
+                    self.evicted += 1
+            else:
+                channels.move_to_end(nid)
+            channel.append(when, value)
+
+    def history(self, nid, since=None):
+        """Return the (monotonic time, value) changes of a channel.
+
+        Only changes after 'since' are returned when it is given.
+        """
+        with self._lock:
+            channel = self._channels.get(nid)
+            if channel is None:
+                return []
+            return channel.since(float('-inf') if since is None else since)
+
+    def last_change(self, nid):
+        """Return the (monotonic time, value) of the last change, or None."""
+        with self._lock:
+            channel = self._channels.get(nid)
+            return None if channel is None else channel.last()
+
+    def duty_cycle(self, nid, window, now=None):
+        """Return the fraction of the last 'window' seconds a channel was on.
+
+        Only the recorded part of the window counts. Returns None
+        when nothing was recorded in it.
+        """
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            channel = self._channels.get(nid)
+            if channel is None or not channel.count:
+                return None
+            begin = max(now - window, channel.oldest_time())
+            if begin >= now:
+                return None
+            on_time = channel.on_time_until(now) - \
+                channel.on_time_until(begin)
+        return on_time / (now - begin)
+
+    def stats(self):
+        """Return the number of channels and entries held."""
+        with self._lock:
+            return {
+                'channels': len(self._channels),
+                'entries': sum(len(channel) for channel
+                               in self._channels.values()),
+                'evicted': self.evicted,
+            }
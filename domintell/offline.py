@@ -0,0 +1,223 @@
+"""Decode captured gateway traffic without a gateway.
+
+A capture holds one received line per line of text, optionally
+preceded by a timestamp and a tab: "1697551234.5\\tIS8  0001I01".
+Empty lines and lines starting with '#' are skipped. Decoding is free
+of side effects: no sensors, callbacks or persistence are involved.
+
+    python -m domintell.offline CAPTURE [-o OUT] [--format csv|json]
+                                        [--processes N]
+"""
+import mmap
+import os
+import sys
+from collections import namedtuple
+
+from .decoder import ClockFrame, MaskFrame, StatusFrame, decode
+
+# The command line and process pool modules are imported when used,
+# decode_records needs neither.
+# pylint: disable=import-outside-toplevel
+
+# Decoded transitions, one list per column.
+Columns = namedtuple('Columns', ('timestamp', 'id', 'old', 'new'))
+
+# Files smaller than this are not worth splitting over processes.
+MIN_CHUNK_SIZE = 1 << 20
+
+
+def read_capture(data, start=0, end=None):
+    """Yield (timestamp, line) for the lines of a capture buffer.
+
+    'data' is bytes or an mmap. Only lines starting in [start, end)
+    are read, so a buffer can be split at any offsets. The timestamp
+    is None when the line has none, lines keep their trailing '\\r'.
+    """
+    if end is None:
+        end = len(data)
+    if start > 0:
+        # the line crossing 'start' belongs to the previous range
+        start = data.find(b'\n', start - 1) + 1 or end
+    while start < end:
+        stop = data.find(b'\n', start)
+        if stop < 0:
+            stop = len(data)
+        raw = data[start:stop]
+        start = stop + 1
+        try:
+            line = raw.decode('utf-8').rstrip('\r\n')
+        except ValueError:
+            continue
+        if not line or line.startswith('#'):
+            continue
+        timestamp = None
+        if '\t' in line:
+            stamp, line = line.split('\t', 1)
+            try:
+                timestamp = float(stamp)
+            except ValueError:
+                continue
+        yield timestamp, line + '\r'
+
+
+def iter_transitions(records, initial=None, unknown=""):
+    """Yield (timestamp, id, old, new) for every value change.
+
+    'records' are (timestamp, line) pairs as read_capture yields.
+    Channels start with their 'initial' value, or 'unknown', like a
+    new gateway starts with empty sensors. The same changes are
+    reported as the callbacks of Gateway.logic would see.
+    """
+    values = dict(initial) if initial else {}
+    masks = {}  # (module id, bank) -> [channel ids, last mask]
+    for timestamp, line in records:
+        try:
+            frame = decode(line, masks=True)
+        except ValueError:
+            continue
+        frame_type = type(frame)
+        if frame_type is MaskFrame:
+            module = masks.get((frame.key, frame.bank))
+            if module is None:
+                ids = tuple(frame.key + suffix for suffix, _ in
+                            frame.module_type.bank_channels(frame.bank))
+                module = masks[(frame.key, frame.bank)] = [ids, None]
+                changed = None
+            else:
+                changed = frame.mask ^ module[1]
+                if not changed:
+                    continue
+            module[1] = frame.mask
+            ids = module[0]
+            for index, new in frame.module_type.channel_values(frame.mask,
+                                                               changed):
+                nid = ids[index]
+                old = values.get(nid, unknown)
+                if old != new:
+                    values[nid] = new
+                    yield timestamp, nid, old, new
+        elif frame_type is StatusFrame:
+            for channel in frame.channels:
+                old = values.get(channel.id, unknown)
+                if old != channel.value:
+                    values[channel.id] = channel.value
+                    yield timestamp, channel.id, old, channel.value
+        elif frame_type is ClockFrame:
+            old = values.get("clock", unknown)
+            if old != frame.value:
+                values["clock"] = frame.value
+                yield timestamp, "clock", old, frame.value
+
+
+def decode_records(records, initial=None):
+    """Return the transitions of (timestamp, line) records as Columns."""
+    columns = Columns([], [], [], [])
+    for transition in iter_transitions(records, initial):
+        for column, value in zip(columns, transition):
+            column.append(value)
+    return columns
+
+
+def _decode_range(args):
+    """Decode a byte range of a capture file, in a worker process.
+
+    The old value of a channel's first change in the range is not
+    known here, it is returned as None for decode_file to resolve.
+    """
+    path, start, end = args
+    with open(path, 'rb') as file_handle:
+        with mmap.mmap(file_handle.fileno(), 0,
+                       access=mmap.ACCESS_READ) as data:
+            columns = Columns([], [], [], [])
+            for transition in iter_transitions(
+                    read_capture(data, start, end), unknown=None):
+                for column, value in zip(columns, transition):
+                    column.append(value)
+    return columns
+
+
+def _resolve(columns, values):
+    """Fill in the unknown old values of a range from the previous ones.
+
+    Channels whose first change in the range turns out not to be a
+    change are dropped. 'values' is updated to the end of the range.
+    """
+    resolved = Columns([], [], [], [])
+    for timestamp, nid, old, new in zip(*columns):
+        if old is None:
+            old = values.get(nid, "")
+            if old == new:
+                continue
+        values[nid] = new
+        resolved.timestamp.append(timestamp)
+        resolved.id.append(nid)
+        resolved.old.append(old)
+        resolved.new.append(new)
+    return resolved
+
+
+def decode_file(path, processes=None):
+    """Yield Columns of the transitions of a capture file, in order.
+
+    The file is memory-mapped. With several processes, each decodes
+    a range of the file and the ranges are stitched together in order,
+    so the result is the same as a single pass.
+    """
+    size = os.path.getsize(path)
+    if not size:
+        return
+    if processes is None:
+        processes = os.cpu_count() or 1
+    num_ranges = max(1, min(processes * 4, size // MIN_CHUNK_SIZE))
+    bounds = [size * index // num_ranges for index in range(num_ranges + 1)]
+    ranges = [(path, bounds[index], bounds[index + 1])
+              for index in range(num_ranges)]
+    values = {}
+    if processes <= 1 or num_ranges == 1:
+        for args in ranges:
+            yield _resolve(_decode_range(args), values)
+        return
+    import multiprocessing
+    with multiprocessing.Pool(processes) as pool:
+        for columns in pool.imap(_decode_range, ranges):
+            yield _resolve(columns, values)
+
+
+def main(argv=None):
+    """Decode a capture file to CSV rows or JSON columns."""
+    import argparse
+    import csv
+    import json
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('capture', help='captured lines, one per line')
+    parser.add_argument('-o', '--output', help='output file, default stdout')
+    parser.add_argument('--format', choices=('csv', 'json'), default='csv')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes, default one per CPU')
+    args = parser.parse_args(argv)
+
+    if args.output:
+        out = open(args.output, 'w', newline='')
+    else:
+        out = sys.stdout
+    try:
+        chunks = decode_file(args.capture, args.processes)
+        if args.format == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(Columns._fields)
+            for columns in chunks:
+                writer.writerows(zip(*columns))
+        else:
+            merged = Columns([], [], [], [])
+            for columns in chunks:
+                for column, values in zip(merged, columns):
+                    column.extend(values)
+            json.dump(merged._asdict(), out)
+            out.write('\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
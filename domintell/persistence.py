@@ -0,0 +1,147 @@
+"""Persistence helpers for the Domintell gateway."""
+import logging
+import os
+import pickle
+import struct
+import threading
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+# Journal records are a little-endian length followed by a pickle.
+JOURNAL_HEADER = struct.Struct('<I')
+JOURNAL_SNAPSHOT = 'S'
+JOURNAL_CHANGE = 'C'
+
+# Bumped whenever the layout of the topology cache changes.
+TOPOLOGY_VERSION = 1
+
+
+def write_journal_record(file_handle, record):
+    """Append a single record to an open journal file."""
+    data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+    file_handle.write(JOURNAL_HEADER.pack(len(data)) + data)
+
+
+def read_journal_records(file_handle):
+    """Yield (record, end offset) for each complete journal record.
+
+    Stops at the first truncated or unreadable record, which is
+    what an interrupted append leaves behind.
+    """
+    offset = 0
+    while True:
+        header = file_handle.read(JOURNAL_HEADER.size)
+        if len(header) < JOURNAL_HEADER.size:
+            return
+        size, = JOURNAL_HEADER.unpack(header)
+        data = file_handle.read(size)
+        if len(data) < size:
+            return
+        try:
+            record = pickle.loads(data)
+        except (pickle.UnpicklingError, EOFError, ValueError):
+            return
+        offset += JOURNAL_HEADER.size + size
+        yield record, offset
+
+
+def load_topology(filename):
+    """Return the cached topology, {id: (type, desc)}.
+
+    Returns None when there is no usable cache of this version.
+    """
+    try:
+        with open(filename, 'rb') as file_handle:
+            cache = pickle.load(file_handle)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        _LOGGER.warning('Ignoring unreadable topology cache %s', filename)
+        return None
+    if not isinstance(cache, dict) or \
+       cache.get('version') != TOPOLOGY_VERSION:
+        _LOGGER.info('Ignoring outdated topology cache %s', filename)
+        return None
+    return cache['topology']
+
+
+def save_topology(filename, topology):
+    """Atomically replace the topology cache."""
+    tmp_fname = '{}.tmp'.format(filename)
+    with open(tmp_fname, 'wb') as file_handle:
+        pickle.dump({'version': TOPOLOGY_VERSION, 'topology': topology},
+                    file_handle, pickle.HIGHEST_PROTOCOL)
+        file_handle.flush()
+        os.fsync(file_handle.fileno())
+    os.replace(tmp_fname, filename)
+
+
+class PersistenceWriter(threading.Thread):
+    """Background thread coalescing sensor changes into few saves.
+
+    Changes are saved at most 'interval' seconds after the first
+    unsaved change, or as soon as 'max_changes' changes are pending.
+    Pending changes are saved when the writer is stopped.
+    """
+
+    def __init__(self, save, interval=1.0, max_changes=100):
+        """Setup writer calling 'save' to write the sensors."""
+        threading.Thread.__init__(self, name='domintell-persistence')
+        self.daemon = True
+        self.save = save
+        self.interval = interval
+        self.max_changes = max_changes
+        self._cond = threading.Condition()
+        self._changes = 0
+        self._first_change = None
+        self._stopping = False
+
+    def notify(self):
+        """Record a change, never blocks on disk."""
+        with self._cond:
+            self._changes += 1
+            if self._changes == 1:
+                self._first_change = time.monotonic()
+                self._cond.notify()
+            elif self._changes >= self.max_changes:
+                self._cond.notify()
+
+    def stop(self):
+        """Save pending changes and stop the thread."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self.is_alive():
+            self.join()
+
+    def _wait(self):
+        """Wait until a save is due.
+
+        Return the number of changes and whether the writer stops.
+        """
+        with self._cond:
+            while not self._stopping and self._changes < self.max_changes:
+                if not self._changes:
+                    self._cond.wait()
+                    continue
+                remaining = self._first_change + self.interval - \
+                    time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            changes, self._changes = self._changes, 0
+            return changes, self._stopping
+
+    def run(self):
+        """Save the sensors whenever changes are due."""
+        while True:
+            changes, stopping = self._wait()
+            if changes:
+                _LOGGER.debug('Saving sensors, %s changes', changes)
+                try:
+                    self.save()
+                except Exception as exception:  # pylint: disable=W0703
+                    _LOGGER.exception(exception)
+            if stopping:
+                return
@@ -0,0 +1,271 @@
+"""Drive many Domintell DETH01 gateways from a single event loop."""
+import asyncio
+import logging
+import socket
+import time
+from collections import ChainMap
+
+from .aio import AsyncDeth01Gateway, Deth01Protocol, KEEPALIVE_INTERVAL
+from .domintell import PONG_TIMEOUT
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class PooledGateway(AsyncDeth01Gateway):
+    """Gateway session sharing the endpoint and timers of a GatewayPool."""
+
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, pool, host, event_callback=None,
+                 persistence=False, persistence_file='domintell.pickle',
+                 port=17481, timeout=1.0, reconnect_timeout=10.0,
+                 topology_cache=False):
+        """Setup a session of the pool."""
+        AsyncDeth01Gateway.__init__(self, host, event_callback, persistence,
+                                    persistence_file, port, timeout,
+                                    reconnect_timeout, pool.loop,
+                                    topology_cache)
+        self.pool = pool
+        self.connecting = None  # pending connect task
+        self.pong_timeout = PONG_TIMEOUT
+        # time.monotonic() timers, driven by the pool
+        self.retry_at = 0.0  # next connect attempt
+        self.ping_sent = None  # last PING of the open session
+        self.next_ping = None
+
+    async def start(self):
+        """Prepare the session, the pool connects it."""
+        self.loop = self.pool.loop
+        self._session_opened = asyncio.Event()
+        self._session_lost = asyncio.Event()
+
+    def is_open(self):
+        """Return True when the session is opened."""
+        return self._session_opened is not None and \
+            self._session_opened.is_set()
+
+    async def connect(self):
+        """Login through the shared endpoint."""
+        self._count('connects')
+        self._session_opened.clear()
+        self.framer.reset()
+        self._sendto("LOGIN")
+        try:
+            await asyncio.wait_for(self._session_opened.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            self._count('connect_failures')
+            return False
+        self._sendto("APPINFO")
+        self._sendto("PING")
+        self.ping_sent = time.monotonic()
+        return True
+
+    def disconnect(self):
+        """Forget the session, the shared endpoint stays open."""
+        if self._session_opened is not None:
+            self._session_opened.clear()
+
+    def _sendto(self, message):
+        """Send a datagram through the shared endpoint."""
+        transport = self.pool.transport
+        if transport is None:
+            _LOGGER.error('Send to server failed, pool not started.')
+            return
+        transport.sendto(message.encode('utf-8'), self.server_address)
+
+
+class PoolProtocol(Deth01Protocol):
+    """Datagram protocol routing datagrams by source address."""
+
+    def __init__(self, pool):
+        Deth01Protocol.__init__(self, None)
+        self.pool = pool
+
+    def connection_made(self, transport):
+        """The shared endpoint is ready."""
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        """Hand the datagram to the gateway it comes from."""
+        gateway = self.pool.gateways.get(addr[:2])
+        if gateway is None:
+            _LOGGER.debug('Ignoring datagram from %s', addr)
+            return
+        self.feed(gateway, data)
+
+    def error_received(self, exc):
+        """Errors are not tied to a session on an unconnected endpoint."""
+        _LOGGER.error('Receive failed: %s', exc)
+
+    def connection_lost(self, exc):
+        """All sessions are gone with the endpoint."""
+        for gateway in self.pool.gateways.values():
+            gateway.disconnect()
+        self.pool.wakeup()
+
+
+class GatewayPool(object):
+    """Multiplex many gateway sessions over one endpoint and one task.
+
+    All sessions share a single UDP socket, a single receive path and
+    a single timer task, so adding gateways adds no threads. The task
+    sleeps until the earliest PING, PONG timeout or reconnect of any
+    gateway. Each gateway keeps its own sensors and reconnect backoff.
+    """
+
+    def __init__(self, local_address=('0.0.0.0', 0),
+                 keepalive_interval=KEEPALIVE_INTERVAL, loop=None):
+        """Setup an empty pool."""
+        self.local_address = local_address
+        self.keepalive_interval = keepalive_interval
+        self.loop = loop
+        self.gateways = {}  # server address -> PooledGateway
+        self.transport = None
+        self._task = None
+        self._wakeup = None  # set to run the timers again
+
+    def add_gateway(self, host, event_callback=None, **kwargs):
+        """Add a gateway session and return it.
+
+        Keyword arguments are passed to PooledGateway. The host is
+        resolved once, as datagrams are routed by source address.
+        """
+        gateway = PooledGateway(self, socket.gethostbyname(host),
+                                event_callback, **kwargs)
+        self.gateways[gateway.server_address] = gateway
+        if self.transport is not None:
+            self.loop.create_task(self._start_gateway(gateway))
+        return gateway
+
+    def remove_gateway(self, gateway):
+        """Remove a gateway session from the pool."""
+        self.gateways.pop(gateway.server_address, None)
+        if gateway.connecting is not None:
+            gateway.connecting.cancel()
+        gateway.disconnect()
+
+    async def start(self):
+        """Open the shared endpoint and connect all gateways."""
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: PoolProtocol(self), local_addr=self.local_address)
+        for gateway in list(self.gateways.values()):
+            await self._start_gateway(gateway)
+        self._task = self.loop.create_task(self._run())
+
+    async def stop(self):
+        """Stop the keepalive task and close the shared endpoint."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for gateway in self.gateways.values():
+            if gateway.connecting is not None:
+                gateway.connecting.cancel()
+            await gateway.stop()
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    async def _start_gateway(self, gateway):
+        """Prepare a gateway and start connecting it."""
+        await gateway.start()
+        self._connect(gateway)
+
+    def wakeup(self):
+        """Run the timers of the gateways again."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _connect(self, gateway):
+        """Start a connect task unless one is pending."""
+        if gateway.connecting is not None:
+            return
+
+        def done(task):
+            gateway.connecting = None
+            if task.cancelled():
+                return
+            if task.exception() is None and task.result():
+                gateway.backoff.reset()
+                gateway.next_ping = gateway.ping_sent + \
+                    self.keepalive_interval
+            else:
+                delay = gateway.backoff.next()
+                _LOGGER.info('Waiting %s secs before trying to connect '
+                             '%s again.', delay, gateway.server_address)
+                gateway.retry_at = time.monotonic() + delay
+            self.wakeup()
+
+        gateway.connecting = self.loop.create_task(gateway.connect())
+        gateway.connecting.add_done_callback(done)
+
+    def _run_timers(self, gateway, now):
+        """Run the due timers of a gateway.
+
+        Return the time.monotonic() of its next timer, or None while
+        it is connecting.
+        """
+        if gateway.connecting is not None:
+            return None
+        if not gateway.is_open():
+            if now < gateway.retry_at:
+                return gateway.retry_at
+            self._connect(gateway)
+            return None
+        ping_sent = gateway.ping_sent
+        if gateway.last_pong is None or gateway.last_pong < ping_sent:
+            pong_due = ping_sent + gateway.pong_timeout
+            if now >= pong_due:
+                _LOGGER.error('No PONG from %s within %s secs.',
+                              gateway.server_address, gateway.pong_timeout)
+                gateway.disconnect()
+                self._connect(gateway)
+                return None
+        else:
+            pong_due = None
+        if now >= gateway.next_ping:
+            gateway._sendto("PING")  # pylint: disable=W0212
+            gateway.ping_sent = now
+            gateway.next_ping = now + self.keepalive_interval
+            pong_due = now + gateway.pong_timeout
+        if pong_due is None:
+            return gateway.next_ping
+        return min(gateway.next_ping, pong_due)
+
+    async def _run(self):
+        """Keep all sessions alive with a single timer task."""
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            deadline = now + self.keepalive_interval
+            for gateway in list(self.gateways.values()):
+                due = self._run_timers(gateway, now)
+                if due is not None:
+                    deadline = min(deadline, due)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),
+                                       max(0.0, deadline - now))
+            except asyncio.TimeoutError:
+                pass
+
+    @property
+    def sensors(self):
+        """Combined lookup of the sensors of all gateways.
+
+        When the same id exists on several gateways, the gateway added
+        first wins; use find_sensor to get all of them.
+        """
+        return ChainMap(*(gateway.sensors
+                          for gateway in self.gateways.values()))
+
+    def find_sensor(self, nid):
+        """Return a list of (gateway, sensor) for a sensor id."""
+        return [(gateway, gateway.sensors[nid])
+                for gateway in self.gateways.values()
+                if nid in gateway.sensors]
@@ -0,0 +1,86 @@
+"""Timers of the threaded gateway loop."""
+import heapq
+import itertools
+import random
+import time
+
+
+class Scheduler(object):
+    """Named one-shot timers kept in a heap.
+
+    Scheduling a name again replaces its timer. Timers are run by
+    run_due from the thread owning the scheduler, which then sleeps
+    until the returned delay or an earlier event.
+    """
+
+    def __init__(self):
+        self._heap = []  # (deadline, sequence, name)
+        self._timers = {}  # name -> (deadline, sequence, func)
+        self._sequence = itertools.count()
+
+    def __contains__(self, name):
+        return name in self._timers
+
+    def call_at(self, name, deadline, func):
+        """Call func() at the time.monotonic() 'deadline'."""
+        sequence = next(self._sequence)
+        self._timers[name] = (deadline, sequence, func)
+        heapq.heappush(self._heap, (deadline, sequence, name))
+
+    def call_later(self, name, delay, func):
+        """Call func() in 'delay' seconds."""
+        self.call_at(name, time.monotonic() + delay, func)
+
+    def cancel(self, name):
+        """Cancel a timer, unknown names are ignored."""
+        self._timers.pop(name, None)
+
+    def run_due(self):
+        """Run the due timers.
+
+        Return the number of seconds until the next timer, or None
+        when no timer is left.
+        """
+        heap = self._heap
+        timers = self._timers
+        while heap:
+            deadline, sequence, name = heap[0]
+            timer = timers.get(name)
+            if timer is None or timer[1] != sequence:
+                # cancelled or replaced
+                heapq.heappop(heap)
+                continue
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                return delay
+            heapq.heappop(heap)
+            del timers[name]
+            timer[2]()
+        return None
+
+
+class Backoff(object):
+    """Exponential reconnect delays with jitter.
+
+    Delays double from 'initial' up to 'maximum' and are reduced by
+    up to 'jitter' of their value, so gateways restarting together do
+    not reconnect in step.
+    """
+
+    def __init__(self, initial=0.5, maximum=10.0, factor=2.0, jitter=0.2):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def reset(self):
+        """Start again from the initial delay."""
+        self.attempts = 0
+
+    def next(self):
+        """Return the delay before the next attempt."""
+        delay = min(self.maximum,
+                    self.initial * self.factor ** min(self.attempts, 32))
+        self.attempts += 1
+        return delay * (1.0 - random.uniform(0.0, self.jitter))
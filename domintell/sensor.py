@@ -0,0 +1,211 @@
+"""Sensor records of a Domintell gateway."""
+import sys
+from collections import namedtuple
+from collections.abc import Mapping
+from enum import Enum
+
+from .decoder import parse_id
+
+SENSOR_KEYS = ('id', 'type', 'desc', 'value')
+
+# Immutable copy of a sensor, as returned to other threads.
+SensorState = namedtuple('SensorState', SENSOR_KEYS)
+
+_new_state = tuple.__new__  # skips the argument handling of SensorState
+
+# Read-only {id: SensorState} as of a state version, see Generation.
+Snapshot = namedtuple('Snapshot', ('version', 'sensors'))
+
+# States changed after a version, all states when 'reset' is True
+# because the change chain no longer reaches back that far.
+Changes = namedtuple('Changes', ('version', 'sensors', 'reset'))
+
+
+class SensorType(str, Enum):
+    """Kind of sensor, compares and formats as its string value."""
+
+    INPUT = "input"
+    OUTPUT = "output"
+    AMPLI = "ampli"
+    CLOCK = "clock"
+
+    def __str__(self):
+        return self.value
+
+    def __format__(self, format_spec):
+        return self.value.__format__(format_spec)
+
+
+class Sensor(Mapping):
+    """State of a single channel.
+
+    Attributes are updated by the gateway. The record also behaves as
+    a read-only mapping with the keys "id", "type", "desc" and
+    "value", so sensor["value"] keeps working.
+    """
+
+    __slots__ = ('id', 'type', 'desc', 'value', 'module', 'serial',
+                 'channel')
+
+    # pylint: disable=too-many-arguments,redefined-builtin
+
+    def __init__(self, id, type, desc="", value=""):
+        """Create a sensor, the id is interned and pre-parsed."""
+        self.id = sys.intern(id)
+        self.type = SensorType(type)
+        self.desc = desc
+        self.value = value
+        self.module, self.serial, self.channel = parse_id(id)
+
+    @classmethod
+    def from_dict(cls, sensor):
+        """Create a sensor from a mapping with the sensor keys."""
+        return cls(sensor["id"], sensor["type"], sensor["desc"],
+                   sensor["value"])
+
+    def state(self):
+        """Return the current state as an immutable SensorState."""
+        return _new_state(SensorState,
+                          (self.id, self.type, self.desc, self.value))
+
+    def __getitem__(self, key):
+        if key in SENSOR_KEYS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(SENSOR_KEYS)
+
+    def __len__(self):
+        return len(SENSOR_KEYS)
+
+    def __reduce__(self):
+        return (Sensor, (self.id, self.type.value, self.desc, self.value))
+
+    def __repr__(self):
+        return 'Sensor(%r, %r, %r, %r)' % (self.id, self.type.value,
+                                           self.desc, self.value)
+
+
+class ModuleChannels(object):
+    """Channels of one bank of a module and its last status mask."""
+
+    __slots__ = ('sensors', 'mask')
+
+    def __init__(self, sensors, mask=None):
+        self.sensors = sensors
+        self.mask = mask
+
+
+class ChangeNode(object):
+    """Ids changed by a generation, linked to the previous generation.
+
+    The writer cuts the chain by clearing 'previous' once it is long
+    enough; 'previous_version' tells readers where a cut chain ends.
+    """
+
+    __slots__ = ('version', 'ids', 'previous_version', 'previous')
+
+    def __init__(self, version, ids, previous_version, previous):
+        self.version = version
+        self.ids = ids
+        self.previous_version = previous_version
+        self.previous = previous
+
+
+class Generation(Mapping):
+    """Immutable {id: SensorState} published by the reader thread.
+
+    A generation shares its base dict with its predecessors and only
+    copies the states changed since the base was built, which are
+    merged into a new base once they outgrow it.
+    """
+
+    __slots__ = ('version', 'changes', '_base', '_overlay')
+
+    def __init__(self, version, base, overlay, changes):
+        self.version = version
+        self.changes = changes  # ChangeNode of this generation
+        self._base = base
+        self._overlay = overlay
+
+    @classmethod
+    def from_sensors(cls, version, sensors):
+        """Return a generation starting a new change chain."""
+        base = {nid: sensor.state() for nid, sensor in sensors.items()}
+        return cls(version, base, {}, ChangeNode(version, (), version, None))
+
+    def evolve(self, sensors, ids):
+        """Return the next generation, with the states of 'ids' updated.
+
+        'sensors' maps the ids to their Sensor records.
+        """
+        states = {}
+        for nid in ids:
+            sensor = sensors[nid]
+            states[nid] = _new_state(SensorState, (nid, sensor.type,
+                                                   sensor.desc, sensor.value))
+        base = self._base
+        overlay = self._overlay.copy()
+        overlay.update(states)
+        if len(overlay) ** 2 > 32 * len(base):
+            # merging costs len(base), copying the overlay len(overlay)
+            base = base.copy()
+            base.update(overlay)
+            overlay = {}
+        version = self.version + 1
+        return Generation(version, base, overlay, ChangeNode(
+            version, tuple(states), self.version, self.changes))
+
+    def __getitem__(self, nid):
+        state = self._overlay.get(nid)
+        if state is None:
+            return self._base[nid]
+        return state
+
+    def __contains__(self, nid):
+        return nid in self._overlay or nid in self._base
+
+    def __iter__(self):
+        overlay = self._overlay
+        base = self._base
+        yield from base
+        for nid in overlay:
+            if nid not in base:
+                yield nid
+
+    def __len__(self):
+        base = self._base
+        return len(base) + sum(1 for nid in self._overlay if nid not in base)
+
+    def to_dict(self):
+        """Return the states as a plain dict."""
+        states = dict(self._base)
+        states.update(self._overlay)
+        return states
+
+    def __reduce__(self):
+        return (dict, (self.to_dict(),))
+
+
+def saved_state(state):
+    """Return the (type, desc, value) tuple persisted for a SensorState.
+
+    The id is the key it is saved under, the type is saved as its
+    string, so files do not reference module classes.
+    """
+    return (state.type.value, state.desc, state.value)
+
+
+def upgrade_sensors(sensors):
+    """Convert saved sensors to Sensor records.
+
+    Files hold (type, desc, value) tuples, older files Sensor records
+    or plain dicts.
+    """
+    for nid, sensor in sensors.items():
+        if isinstance(sensor, tuple):
+            sensors[nid] = Sensor(nid, *sensor)
+        elif not isinstance(sensor, Sensor):
+            sensors[nid] = Sensor.from_dict(sensor)
+    return sensors
@@ -0,0 +1,80 @@
+"""Counters and histograms of a Domintell gateway."""
+import bisect
+import time
+from collections import Counter
+
+# Upper bounds in seconds of the histogram buckets, last is overflow.
+BUCKETS = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+
+
+class Histogram(object):
+    """Durations counted in fixed logarithmic buckets."""
+
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        """Add a duration."""
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def snapshot(self):
+        """Return the histogram as a dict."""
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+            'buckets': dict(zip(BUCKETS + (float('inf'),), self.buckets)),
+        }
+
+
+class Metrics(object):
+    """Hot path instrumentation, only allocated when enabled.
+
+    Counters may be updated from the reader and the persistence
+    threads without locking, a lost increment is acceptable here.
+    The optional profile hook is called with (name, seconds) for
+    every timed section.
+    """
+
+    def __init__(self, profile_hook=None):
+        self.counters = Counter()
+        self.histograms = {}
+        self.gauges = {}
+        self.profile_hook = profile_hook
+        self.started = time.monotonic()
+
+    def count(self, name, value=1):
+        """Increment a counter."""
+        self.counters[name] += value
+
+    def gauge(self, name, value):
+        """Set the current value of a gauge."""
+        self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        """Record the duration of a timed section."""
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+        if self.profile_hook is not None:
+            self.profile_hook(name, seconds)
+
+    def snapshot(self):
+        """Return all metrics as plain dicts."""
+        return {
+            'uptime': time.monotonic() - self.started,
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+            'histograms': {name: histogram.snapshot() for name, histogram
+                           in list(self.histograms.items())},
+        }
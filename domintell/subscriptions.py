@@ -0,0 +1,114 @@
+"""Filtered subscriptions to sensor changes."""
+import logging
+
+from .sensor import SensorType
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Subscription(object):
+    """Callback for the changes matching a set of filters."""
+
+    __slots__ = ('callback', 'nid', 'prefix', 'sensor_type', 'predicate',
+                 'bucket')
+
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, callback, nid=None, prefix=None, sensor_type=None,
+                 predicate=None):
+        self.callback = callback
+        self.nid = nid
+        self.prefix = prefix
+        self.sensor_type = sensor_type
+        self.predicate = predicate
+        self.bucket = None
+
+    def matches(self, sensor, value):
+        """Check the filters that are not covered by the index."""
+        if self.nid is not None and sensor.id != self.nid:
+            return False
+        if self.sensor_type is not None and \
+           sensor.type is not self.sensor_type:
+            return False
+        if self.prefix is not None and \
+           sensor.id[_PREFIXES[len(self.prefix)]] != self.prefix:
+            return False
+        if self.predicate is not None and not self.predicate(value):
+            return False
+        return True
+
+
+# Prefix length -> part of the sensor id it is compared with.
+_PREFIXES = {
+    3: slice(0, 3),  # module code, e.g. "IS8"
+    6: slice(3, 9),  # serial, e.g. "0012AB"
+    9: slice(0, 9),  # module id, e.g. "IS80012AB"
+}
+
+
+class SubscriptionIndex(object):
+    """Subscriptions indexed by their most selective filter.
+
+    A change only looks up the buckets of its own id, module code,
+    serial, module id and type, so the dispatch cost depends on the
+    number of matching subscriptions, not on the total number.
+    """
+
+    def __init__(self):
+        self._buckets = {}  # (kind, key) -> list of Subscription
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, subscription):
+        """Index a subscription and return it."""
+        if subscription.prefix is not None and \
+           len(subscription.prefix) not in _PREFIXES:
+            raise ValueError('Prefix must be a module code, serial or '
+                             'module id: %r' % subscription.prefix)
+        if subscription.sensor_type is not None:
+            subscription.sensor_type = SensorType(subscription.sensor_type)
+        if subscription.nid is not None:
+            bucket = ('id', subscription.nid)
+        elif subscription.prefix is not None:
+            bucket = (len(subscription.prefix), subscription.prefix)
+        elif subscription.sensor_type is not None:
+            bucket = ('type', subscription.sensor_type)
+        else:
+            bucket = ('all', None)
+        subscription.bucket = bucket
+        self._buckets.setdefault(bucket, []).append(subscription)
+        self._count += 1
+        return subscription
+
+    def remove(self, subscription):
+        """Remove a subscription, unknown ones are ignored."""
+        subscriptions = self._buckets.get(subscription.bucket)
+        if subscriptions is None or subscription not in subscriptions:
+            return
+        subscriptions.remove(subscription)
+        if not subscriptions:
+            del self._buckets[subscription.bucket]
+        self._count -= 1
+
+    def match(self, sensor, value):
+        """Return the subscriptions matching a new value of a sensor."""
+        nid = sensor.id
+        buckets = self._buckets
+        matched = []
+        for bucket in (('id', nid), (3, nid[:3]), (6, nid[3:9]),
+                       (9, nid[:9]), ('type', sensor.type), ('all', None)):
+            subscriptions = buckets.get(bucket)
+            if subscriptions is not None:
+                matched.extend(subscription for subscription in subscriptions
+                               if subscription.matches(sensor, value))
+        return matched
+
+    def dispatch(self, sensor, old, new):
+        """Call the matching subscriptions with (id, old, new)."""
+        for subscription in self.match(sensor, new):
+            try:
+                subscription.callback(sensor.id, old, new)
+            except Exception as exception:  # pylint: disable=W0703
+                _LOGGER.exception(exception)
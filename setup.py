@@ -9,4 +9,9 @@ setup(name='pydomintell',
       license='MIT',
       install_requires=[],
       packages=['domintell'],
+      entry_points={
+          'console_scripts': [
+              'domintell-decode=domintell.offline:main',
+          ],
+      },
       zip_safe=True)
@@ -0,0 +1,65 @@
+"""Fixtures shared by the tests."""
+# pylint: disable=protected-access
+import time
+
+import pytest
+
+from domintell.domintell import Gateway
+from domintell.fake import FakeDeth01Server
+
+
+class MutedServer(FakeDeth01Server):
+    """Fake DETH01 that can stop answering some messages."""
+
+    def __init__(self):
+        FakeDeth01Server.__init__(self)
+        self.ignored = set()  # messages left unanswered, e.g. "PING"
+
+    def handle(self, message):
+        """Answer like a DETH01, except the ignored messages."""
+        if message in self.ignored:
+            return
+        FakeDeth01Server.handle(self, message)
+
+
+def poll(condition, timeout=5.0):
+    """Poll until condition() is true, fail after 'timeout' seconds."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def wait_for():
+    """Return a function polling a condition until it is true."""
+    return poll
+
+
+@pytest.fixture
+def server():
+    """Run a fake DETH01 for the duration of a test."""
+    fake = MutedServer()
+    fake.start()
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def make_gateway(tmp_path):
+    """Return a factory of gateways sending nothing.
+
+    The factory applies the given frames to the new gateway, its
+    files are kept in tmp_path and its commands are not paced.
+    """
+    def make(frames=(), event_callback=None, **kwargs):
+        kwargs.setdefault('persistence_file',
+                          str(tmp_path / 'domintell.pickle'))
+        gateway = Gateway(event_callback, **kwargs)
+        gateway._sendto = lambda message: None
+        gateway.commands.rate = 0
+        gateway.commands._send = gateway._sendto
+        for frame in frames:
+            gateway.logic(frame)
+        return gateway
+    return make
@@ -0,0 +1,77 @@
+"""Tests for the asyncio gateway against a fake DETH01."""
+# pylint: disable=protected-access
+import asyncio
+
+from domintell.aio import AsyncDeth01Gateway
+
+
+def connects(gateway):
+    """Return the number of connect attempts of a gateway."""
+    return gateway.stats()['counters'].get('connects', 0)
+
+
+def test_reconnect_after_session_lost(server):
+    """A lost session is reopened once, not in a loop."""
+    async def run():
+        gateway = AsyncDeth01Gateway(server.address[0], port=server.address[1])
+        gateway.enable_metrics()
+        await gateway.start()
+        await gateway.wait_ready(2)
+        assert connects(gateway) == 1
+        gateway.connection_lost()
+        await asyncio.sleep(0.5)
+        assert connects(gateway) == 2
+        await gateway.wait_ready(2)
+        await gateway.stop()
+
+    asyncio.run(asyncio.wait_for(run(), 10))
+
+
+def test_stale_protocol_is_ignored(server):
+    """connection_lost of a replaced endpoint keeps the new session."""
+    async def run():
+        gateway = AsyncDeth01Gateway(server.address[0], port=server.address[1])
+        await gateway.start()
+        await gateway.wait_ready(2)
+        old = gateway.protocol
+        gateway.connection_lost()
+        await asyncio.sleep(0.2)
+        await gateway.wait_ready(2)
+        assert gateway.protocol is not old
+        old.connection_lost(None)
+        await asyncio.sleep(0.1)
+        assert not gateway._session_lost.is_set()
+        await gateway.stop()
+
+    asyncio.run(asyncio.wait_for(run(), 10))
+
+
+def test_stop_cancels_timers(server):
+    """No command, retransmission or flush runs after stop."""
+    async def run():
+        gateway = AsyncDeth01Gateway(server.address[0], port=server.address[1])
+        gateway.commands.rate = 1.0
+        gateway.batch_events = True
+        gateway.batch_window = 5.0
+        await gateway.start()
+        await gateway.wait_ready(2)
+        server.send_lines(["BIR  0002O00", "BIR  0003O00"])
+        while "BIR000003-1" not in gateway.snapshot().sensors:
+            await asyncio.sleep(0.01)
+        server.send_lines(["BIR  0002O02"])
+        await asyncio.sleep(0.05)
+        gateway.set_value_confirmed("BIR000002-1", 0, 0, "on")
+        gateway.set_value("BIR000003-1", 0, 0, "on")
+        await asyncio.sleep(0.05)
+        assert gateway._commands_handle is not None
+        assert gateway._acks_handle is not None
+        assert gateway._flush_handle is not None
+        await gateway.stop()
+        assert gateway._commands_handle is None
+        assert gateway._acks_handle is None
+        assert gateway._flush_handle is None
+        await asyncio.sleep(1.2)
+        assert len(gateway.commands) == 1
+        assert server.received == ["BIR000002-1%I"]
+
+    asyncio.run(asyncio.wait_for(run(), 10))
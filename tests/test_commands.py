@@ -0,0 +1,137 @@
+"""Tests for the command pipeline and confirmed commands."""
+# pylint: disable=protected-access
+from domintell.commands import CommandPipeline, CommandTracker
+from domintell.domintell import Gateway
+
+
+def make_tracker():
+    """Return an unpaced pipeline recording sent commands, and its tracker."""
+    sent = []
+    pipeline = CommandPipeline(sent.append, rate=0)
+    tracker = CommandTracker(pipeline, timeout=0.0, retries=2)
+    pipeline.on_sent = tracker.command_sent
+    return sent, pipeline, tracker
+
+
+def test_confirm():
+    """A status frame with the expected value resolves to True."""
+    sent, pipeline, tracker = make_tracker()
+    future = tracker.track("BIR000002-1", "on", "BIR000002-1%I")
+    pipeline.submit("BIR000002-1", "BIR000002-1%I")
+    pipeline.process()
+    assert sent == ["BIR000002-1%I"]
+    tracker.confirm("BIR000002-1", "off")
+    assert not future.done()
+    tracker.confirm("BIR000002-1", "on")
+    assert future.result(0) is True
+    assert not tracker
+
+
+def test_supersede_confirmed():
+    """A newer confirmed command resolves the older one to False."""
+    _, _, tracker = make_tracker()
+    first = tracker.track("BIR000002-1", "on", "BIR000002-1%I")
+    second = tracker.track("BIR000002-1", "off", "BIR000002-1%O")
+    assert first.result(0) is False
+    assert not second.done()
+    assert len(tracker) == 1
+
+
+def test_supersede_in_pipeline():
+    """A plain command replacing a tracked one resolves it to False."""
+    sent, pipeline, tracker = make_tracker()
+    future = tracker.track("BIR000002-1", "on", "BIR000002-1%I")
+    pipeline.submit("BIR000002-1", "BIR000002-1%I")
+    pipeline.submit("BIR000002-1", "BIR000002-1%O")
+    pipeline.process()
+    assert sent == ["BIR000002-1%O"]
+    assert future.result(0) is False
+    assert not tracker
+    assert tracker.expire() is None
+
+
+def test_timeout():
+    """Commands are retransmitted, then fail with TimeoutError."""
+    sent, pipeline, tracker = make_tracker()
+    future = tracker.track("BIR000002-1", "on", "BIR000002-1%I")
+    pipeline.submit("BIR000002-1", "BIR000002-1%I")
+    pipeline.process()
+    for _ in range(2):
+        tracker.expire()
+        pipeline.process()
+    assert sent == ["BIR000002-1%I"] * 3
+    assert tracker.retransmits == 2
+    tracker.expire()
+    assert isinstance(future.exception(0), TimeoutError)
+    assert not tracker
+
+
+# A relay and a dimmer.
+FRAMES = ["BIR  0002O00\r", "DIM  0003D00000000000000000\r"]
+
+
+def test_dimmer_on_off(make_gateway):
+    """1 and 0 switch a DIM channel on and off, they are not levels."""
+    gateway = make_gateway(FRAMES)
+    assert gateway.set_value("DIM000003-1", 0, 0, 1) == "DIM000003-1%I"
+    assert gateway.set_value("DIM000003-1", 0, 0, 0) == "DIM000003-1%O"
+    assert gateway.set_value("DIM000003-1", 0, 0, "on") == "DIM000003-1%I"
+
+
+def test_dimmer_confirmed(make_gateway):
+    """DIM on / off cannot be confirmed and resolves at once."""
+    gateway = make_gateway(FRAMES)
+    future = gateway.set_value_confirmed("DIM000003-1", 0, 0, "on")
+    assert future.result(0) is True
+    assert not gateway.acks
+    assert len(gateway.commands) == 1
+
+
+def test_gateway_confirm(make_gateway):
+    """A confirmed command resolves on the status frame."""
+    gateway = make_gateway(FRAMES)
+    future = gateway.set_value_confirmed("BIR000002-1", 0, 0, 1)
+    gateway.commands.process()
+    gateway.logic("BIR  0002O01\r")
+    assert future.result(0) is True
+
+
+def test_gateway_supersede_with_set_value(make_gateway):
+    """set_value before the send resolves the confirmed command to False."""
+    gateway = make_gateway(FRAMES)
+    future = gateway.set_value_confirmed("BIR000002-1", 0, 0, "on")
+    gateway.set_value("BIR000002-1", 0, 0, "off")
+    gateway.commands.process()
+    assert future.result(0) is False
+    assert not gateway.acks
+
+
+def test_scene_from_published_states(make_gateway):
+    """Scenes are built from the published generation."""
+    gateway = make_gateway(FRAMES)
+    gateway.logic("BU2  0044O00\r")
+    scene = gateway.scene({"BU2000044-3": "on", "DIM000003-2": 40})
+    assert scene.commands == (
+        ("BU2000044-3", "BU2000044-1%I", "on"),
+        ("DIM000003-2", "DIM000003-2%D40", 40))
+    gateway.sensors["BIR000002-1"].value = "on"  # not published
+    future = gateway.set_value_confirmed("BIR000002-1", 0, 0, "on")
+    assert not future.done()
+
+
+def test_confirm_during_block(make_gateway):
+    """A command tracked while a block is applied is confirmed by it."""
+    gateway = make_gateway(FRAMES)
+    index_module = gateway._index_module
+    futures = []
+
+    def index_and_command(frame):
+        # stands for another thread calling set_value_confirmed
+        futures.append(gateway.set_value_confirmed("BIR000002-1", 0, 0,
+                                                   "on"))
+        gateway.commands.process()
+        return index_module(frame)
+
+    gateway._index_module = index_and_command
+    gateway.logic_many(["BIR  0004O00\r", "BIR  0002O01\r"])
+    assert futures[0].result(0) is True
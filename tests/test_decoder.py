@@ -0,0 +1,163 @@
+"""Tests for the frame decoder and Gateway.logic."""
+import random
+
+import pytest
+
+from domintell.decoder import UnknownFrame, decode, parse_id
+from domintell.domintell import Gateway
+
+# A line of each module type, as the gateway sends them.
+FRAMES = [
+    'IS8  0001I05\r',
+    'IS4  0002I0F\r',
+    'DET  0003I01\r',
+    'BIR  0004O81\r',
+    'DMR  0005O1F\r',
+    'BU1  0006I01\r',
+    'BU2  0007I0A\r',
+    'BU4  0008I5F\r',
+    'BU6  0009IFFF\r',
+    'DIM  000AD0A32FF0000000000FF\r',
+    'AMP  000BO1 25\r',
+    'IS8  0001I04\r',
+    'BIR  0004-3Kitchen light[x]\r',
+    '12:34 17/10/26\r',
+    'PONG\r',
+    'IS8  0001I04\r',
+]
+
+# Sensors and update events produced by the original Gateway.logic
+# for FRAMES, before the decoder was table driven.
+BASELINE_SENSORS = {
+    'AMP00000B-1': ('ampli', '', '25'),
+    'BIR000004-1': ('output', '', 'on'),
+    'BIR000004-2': ('output', '', 'off'),
+    'BIR000004-3': ('output', 'Kitchen light', 'off'),
+    'BIR000004-4': ('output', '', 'off'),
+    'BIR000004-5': ('output', '', 'off'),
+    'BIR000004-6': ('output', '', 'off'),
+    'BIR000004-7': ('output', '', 'off'),
+    'BIR000004-8': ('output', '', 'on'),
+    'BU1000006-1': ('input', '', 'on'),
+    'BU2000007-1': ('input', '', 'off'),
+    'BU2000007-2': ('input', '', 'on'),
+    'BU4000008-1': ('input', '', 'on'),
+    'BU4000008-2': ('input', '', 'on'),
+    'BU4000008-3': ('input', '', 'on'),
+    'BU4000008-4': ('input', '', 'on'),
+    'BU6000009-1': ('input', '', 'on'),
+    'BU6000009-2': ('input', '', 'on'),
+    'BU6000009-3': ('input', '', 'on'),
+    'BU6000009-4': ('input', '', 'on'),
+    'BU6000009-5': ('input', '', 'on'),
+    'BU6000009-6': ('input', '', 'on'),
+    'DET000003-1': ('input', '', 'on'),
+    'DIM00000A-1': ('output', '', 10),
+    'DIM00000A-2': ('output', '', 50),
+    'DIM00000A-3': ('output', '', 255),
+    'DIM00000A-4': ('output', '', 0),
+    'DIM00000A-5': ('output', '', 0),
+    'DIM00000A-6': ('output', '', 0),
+    'DIM00000A-7': ('output', '', 0),
+    'DIM00000A-8': ('output', '', 0),
+    'DMR000005-1': ('output', '', 'on'),
+    'DMR000005-2': ('output', '', 'on'),
+    'DMR000005-3': ('output', '', 'on'),
+    'DMR000005-4': ('output', '', 'on'),
+    'DMR000005-5': ('output', '', 'on'),
+    'IS4000002-1': ('input', '', 'on'),
+    'IS4000002-2': ('input', '', 'on'),
+    'IS4000002-3': ('input', '', 'on'),
+    'IS4000002-4': ('input', '', 'on'),
+    'IS8000001-1': ('input', '', 'off'),
+    'IS8000001-2': ('input', '', 'off'),
+    'IS8000001-3': ('input', '', 'on'),
+    'IS8000001-4': ('input', '', 'off'),
+    'IS8000001-5': ('input', '', 'off'),
+    'IS8000001-6': ('input', '', 'off'),
+    'IS8000001-7': ('input', '', 'off'),
+    'IS8000001-8': ('input', '', 'off'),
+    'clock': ('clock', '', '12:34 17/10/26\r'),
+}
+
+BASELINE_EVENTS = [
+    'IS8000001-1', 'IS8000001-2', 'IS8000001-3', 'IS8000001-4', 'IS8000001-5',
+    'IS8000001-6', 'IS8000001-7', 'IS8000001-8', 'IS4000002-1', 'IS4000002-2',
+    'IS4000002-3', 'IS4000002-4', 'DET000003-1', 'BIR000004-1', 'BIR000004-2',
+    'BIR000004-3', 'BIR000004-4', 'BIR000004-5', 'BIR000004-6', 'BIR000004-7',
+    'BIR000004-8', 'DMR000005-1', 'DMR000005-2', 'DMR000005-3', 'DMR000005-4',
+    'DMR000005-5', 'BU1000006-1', 'BU2000007-1', 'BU2000007-2', 'BU4000008-1',
+    'BU4000008-2', 'BU4000008-3', 'BU4000008-4', 'BU6000009-1', 'BU6000009-2',
+    'BU6000009-3', 'BU6000009-4', 'BU6000009-5', 'BU6000009-6', 'DIM00000A-1',
+    'DIM00000A-2', 'DIM00000A-3', 'DIM00000A-4', 'DIM00000A-5', 'DIM00000A-6',
+    'DIM00000A-7', 'DIM00000A-8', 'AMP00000B-1', 'IS8000001-1', 'clock',
+]
+
+
+def random_frames(seed, count=3000):
+    """Return random status and APPINFO lines of all module types."""
+    rand = random.Random(seed)
+    frames = []
+    for _ in range(count):
+        module = rand.choice(("IS8", "IS4", "DET", "BIR", "DMR", "BU1",
+                              "BU2", "BU4", "BU6", "DIM", "AMP"))
+        serial = "%6X" % rand.randint(0, 5)
+        if module == "DIM":
+            frames.append(module + serial + "D" + "".join(
+                rand.choice(("00", "FF", "7F", "  ")) for _ in range(8)))
+        elif module == "AMP":
+            frames.append("%s%sO%d %d" % (module, serial, rand.randint(1, 4),
+                                          rand.randint(0, 50)))
+        else:
+            frames.append("%s%s%s%X" % (module, serial, rand.choice("IO"),
+                                        rand.randint(0, 63)))
+        if rand.random() < 0.05:
+            frames.append("%s%s-%X%s[x]" % (module, serial,
+                                            rand.randint(1, 8), "desc"))
+    return [frame + "\r" for frame in frames]
+
+
+def run(frames, many, callback=True):
+    """Apply frames, return the (id, value) events and the sensors."""
+    events = []
+    gateway = Gateway()
+    if callback:
+        gateway.event_callback = lambda update_type, nid: events.append(
+            (nid, gateway.sensors[nid].value))
+    if many:
+        for start in range(0, len(frames), 100):
+            gateway.logic_many(frames[start:start + 100])
+    else:
+        for frame in frames:
+            gateway.logic(frame)
+    sensors = {nid: (sensor.type, sensor.desc, sensor.value)
+               for nid, sensor in gateway.sensors.items()}
+    return events, sensors, gateway.snapshot().sensors.to_dict()
+
+
+def test_logic_matches_baseline(capsys):
+    """Gateway.logic produces the sensors and events of the original."""
+    events, sensors, _ = run(FRAMES, many=False)
+    assert sensors == BASELINE_SENSORS
+    assert [nid for nid, _ in events] == BASELINE_EVENTS
+    assert "New sensor:  IS8000001-1" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('callback', [True, False])
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_logic_many_matches_logic(seed, callback, capsys):
+    """A block applied by logic_many ends in the state logic gives."""
+    frames = random_frames(seed)
+    assert run(frames, True, callback) == run(frames, False, callback)
+    capsys.readouterr()
+
+
+def test_decode_unknown():
+    """Lines that are not understood decode to UnknownFrame."""
+    assert isinstance(decode("XYZ\r"), UnknownFrame)
+
+
+def test_parse_id():
+    """Ids are split into module code, serial and channel."""
+    assert parse_id("IS80012AB-1") == ("IS8", 0x12AB, 1)
+    assert parse_id("clock") == (None, None, None)
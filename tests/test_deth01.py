@@ -0,0 +1,72 @@
+"""Tests for the threaded gateway against a fake DETH01."""
+import pytest
+
+from domintell.deth01 import Deth01Gateway
+
+
+@pytest.fixture
+def gateway(server, wait_for):
+    """Run a threaded gateway connected to the fake DETH01."""
+    client = Deth01Gateway(server.address[0], port=server.address[1])
+    client.enable_metrics()
+    client.keepalive_interval = 0.2
+    client.pong_timeout = 0.1
+    client.start()
+    wait_for(lambda: client.last_pong is not None)
+    yield client
+    client.stop()
+    client.join()
+
+
+class RefusedSocket(object):
+    """Socket of a gateway whose next receive fails."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def recv_into(self, buffer):
+        """Fail like a socket that got an ICMP port unreachable."""
+        raise ConnectionRefusedError
+
+
+def counter(gateway, name):
+    """Return a counter of the gateway metrics."""
+    return gateway.stats()['counters'].get(name, 0)
+
+
+def test_reconnect_after_missing_pong(server, gateway, wait_for):
+    """An unanswered PING reopens the session, which then works."""
+    assert counter(gateway, 'connects') == 1
+    server.ignored.add("PING")
+    wait_for(lambda: counter(gateway, 'reconnects') >= 1)
+    server.ignored.clear()
+    connects = counter(gateway, 'connects')
+    pong = gateway.last_pong
+    wait_for(lambda: gateway.last_pong != pong)
+    assert counter(gateway, 'connects') <= connects + 1
+    server.send_lines(["IS8  0001I01"])
+    wait_for(lambda: "IS8000001-1" in gateway.snapshot().sensors)
+
+
+def test_confirmed_command(server, gateway, wait_for):
+    """A command is confirmed by the status frame of the gateway."""
+    server.send_lines(["BIR  0002O00"])
+    wait_for(lambda: "BIR000002-1" in gateway.snapshot().sensors)
+    future = gateway.set_value_confirmed("BIR000002-1", 0, 0, "on")
+    assert future.result(2) is True
+    assert server.received == ["BIR000002-1%I"]
+
+
+def test_reconnect_after_receive_error(server, gateway, wait_for):
+    """A failed receive reopens the session, the thread keeps running."""
+    gateway.sock = RefusedSocket(gateway.sock)
+    server.send_lines(["IS8  0001I00"])
+    wait_for(lambda: counter(gateway, 'reconnects') >= 1)
+    pong = gateway.last_pong
+    wait_for(lambda: gateway.last_pong != pong)
+    assert gateway.is_alive()
+    server.send_lines(["IS8  0001I01"])
+    wait_for(lambda: "IS8000001-1" in gateway.snapshot().sensors)
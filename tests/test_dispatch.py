@@ -0,0 +1,86 @@
+"""Tests for the callback executor."""
+# pylint: disable=protected-access
+from domintell.dispatch import COALESCE, DROP_NEW, CallbackExecutor
+
+
+class ManualLoop(object):
+    """Stand-in event loop, events run when the test drains them."""
+
+    def __init__(self):
+        self.calls = []
+
+    def call_soon_threadsafe(self, callback):
+        """Remember a callback instead of running it."""
+        self.calls.append(callback)
+
+
+def make_executor(policy=COALESCE, max_pending=2):
+    """Return an executor holding its events until drained."""
+    return CallbackExecutor(max_pending=max_pending, policy=policy,
+                            loop=ManualLoop())
+
+
+def test_coalesce_keeps_latest_of_every_key():
+    """A full executor still delivers the last event of each key."""
+    executor = make_executor()
+    calls = []
+    for key, value in (("a", 1), ("b", 1), ("a", 2), ("c", 1), ("b", 2)):
+        executor.submit(key, calls.append, (key, value))
+    executor._drain()
+    assert calls == [("a", 2), ("b", 2), ("c", 1)]
+    assert executor.dropped == 0
+    assert executor.coalesced == 2
+
+
+def test_coalesce_merges():
+    """The merge function combines the pending and the new args."""
+    executor = make_executor(max_pending=1)
+    calls = []
+
+    def merge(pending, new):
+        return (pending[0] + new[0],)
+
+    executor.submit("batch", calls.append, [1], merge=merge)
+    executor.submit("batch", calls.append, [2], merge=merge)
+    executor._drain()
+    assert calls == [[1, 2]]
+
+
+def test_drop_new():
+    """DROP_NEW keeps the limit and drops the new event."""
+    executor = make_executor(DROP_NEW)
+    calls = []
+    for value in range(3):
+        executor.submit(value, calls.append, value)
+    executor._drain()
+    assert calls == [0, 1]
+    assert executor.dropped == 1
+
+
+def test_gateway_batches_are_not_lost(make_gateway):
+    """Coalesced 'sensors_update' batches keep every change."""
+    events = []
+    gateway = make_gateway(
+        event_callback=lambda update_type, data: events.append(data))
+    gateway.batch_events = True
+    gateway.callback_executor = make_executor(max_pending=1)
+    for frame in ("IS8  0011I01\r", "IS8  0011I00\r", "IS8  0011I01\r"):
+        gateway.logic(frame)
+    gateway.callback_executor._drain()
+    changes = [change for batch in events for change in batch]
+    assert [change[1:] for change in changes
+            if change[0] == "IS8000011-1"] == [
+                ("", "on"), ("on", "off"), ("off", "on")]
+
+
+def test_gateway_last_state_is_delivered(make_gateway):
+    """Every sensor gets a callback after its last change."""
+    updated = []
+    gateway = make_gateway(
+        event_callback=lambda update_type, nid: updated.append(nid))
+    gateway.callback_executor = make_executor(max_pending=3)
+    for frame in ("IS8  0011I01\r", "IS8  0011I02\r", "IS8  0011I00\r"):
+        gateway.logic(frame)
+    gateway.callback_executor._drain()
+    assert set(updated) == set(gateway.sensors)
+    assert gateway.callback_executor.dropped == 0
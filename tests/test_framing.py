@@ -0,0 +1,44 @@
+"""Tests for splitting received datagrams into lines."""
+from domintell.framing import LineFramer
+
+
+def test_line_across_datagrams():
+    """A line split over two datagrams is yielded once completed."""
+    framer = LineFramer()
+    assert list(framer.feed(b"IS8  0001I01\r\nIS8  00")) == ["IS8  0001I01\r"]
+    assert list(framer.feed(b"02I03\r\n")) == ["IS8  0002I03\r"]
+
+
+def test_size_limits_the_buffer():
+    """Only the first 'size' bytes of a reused buffer are read."""
+    framer = LineFramer()
+    buffer = bytearray(b"PONG\r\nstale bytes\n")
+    assert list(framer.feed(buffer, 6)) == ["PONG\r"]
+
+
+def test_invalid_utf8_line_is_skipped():
+    """A line that is not UTF-8 is skipped, the next lines are kept."""
+    framer = LineFramer()
+    assert list(framer.feed(b"IS8  0001I01\r\n\xff\xfe\r\nPONG\r\n")) == [
+        "IS8  0001I01\r", "PONG\r"]
+    assert list(framer.feed(b"\xc3")) == []
+    assert list(framer.feed(b"\r\nPONG\r\n")) == ["PONG\r"]
+
+
+def test_overlong_line_is_dropped():
+    """An overlong line is dropped up to its end, not yielded in part."""
+    framer = LineFramer(max_line=8)
+    assert list(framer.feed(b"PONG\r\n0123456")) == ["PONG\r"]
+    assert list(framer.feed(b"789")) == []
+    assert list(framer.feed(b"abcdef")) == []
+    assert list(framer.feed(b"tail\r\nPONG\r\n")) == ["PONG\r"]
+    assert list(framer.feed(b"IS8  ")) == []
+    assert list(framer.feed(b"I01\n")) == ["IS8  I01"]
+
+
+def test_reset_forgets_the_partial_line():
+    """A new session does not complete the line of the previous one."""
+    framer = LineFramer(max_line=4)
+    list(framer.feed(b"0123456"))
+    framer.reset()
+    assert list(framer.feed(b"PONG\n")) == ["PONG"]
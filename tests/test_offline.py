@@ -0,0 +1,62 @@
+"""Tests for decoding captured traffic."""
+import random
+
+import pytest
+
+from domintell import offline
+
+CAPTURE = b"1.5\tIS8  0001I01\r\n# comment\n\n2.5\tPONG\r\nBIR  0002O03\r\n"
+
+
+def write_capture(path, seed, count=2000):
+    """Write a capture of random mask frames, return its bytes."""
+    rand = random.Random(seed)
+    lines = []
+    for index in range(count):
+        module = rand.choice(("IS8", "BIR", "BU4"))
+        lines.append("%d.%d\t%s%6X%s%02X\r\n" % (
+            index, rand.randint(0, 9), module, rand.randint(1, 3),
+            "O" if module == "BIR" else "I", rand.randint(0, 15)))
+    data = "".join(lines).encode('utf-8')
+    path.write_bytes(data)
+    return data
+
+
+def merged(chunks):
+    """Join the Columns of decode_file into one Columns."""
+    result = offline.Columns([], [], [], [])
+    count = 0
+    for columns in chunks:
+        count += 1
+        for column, values in zip(result, columns):
+            column.extend(values)
+    return result, count
+
+
+@pytest.mark.parametrize('processes', [1, 3])
+def test_ranges_match_single_pass(tmp_path, monkeypatch, processes):
+    """Decoding by ranges gives the transitions of a single pass."""
+    monkeypatch.setattr(offline, 'MIN_CHUNK_SIZE', 1024)
+    path = tmp_path / 'capture.txt'
+    data = write_capture(path, seed=processes)
+    expected = offline.decode_records(offline.read_capture(data))
+    result, count = merged(offline.decode_file(str(path), processes))
+    assert count > 1
+    assert result == expected
+
+
+def test_read_capture():
+    """Timestamps are split off, comments and empty lines skipped."""
+    assert list(offline.read_capture(CAPTURE)) == [
+        (1.5, "IS8  0001I01\r"), (2.5, "PONG\r"), (None, "BIR  0002O03\r")]
+
+
+def test_read_capture_mid_line():
+    """A range starting mid-line begins with the next line."""
+    records = list(offline.read_capture(CAPTURE))
+    for split in range(len(CAPTURE) + 1):
+        first = list(offline.read_capture(CAPTURE, 0, split))
+        second = list(offline.read_capture(CAPTURE, split))
+        assert first + second == records
+    start = CAPTURE.index(b"I01")
+    assert list(offline.read_capture(CAPTURE, start)) == records[1:]
@@ -0,0 +1,92 @@
+"""Tests for saving and loading sensors."""
+# pylint: disable=protected-access
+import os
+import pickle
+
+import pytest
+
+from domintell.sensor import Sensor, SensorType
+
+FRAMES = ["IS8  0001I05\r", "BIR  0002O01\r", "DIM  0003D0A32000000000000FF\r"]
+
+
+def states(gateway):
+    """Return the published states of a gateway as a dict."""
+    return gateway.snapshot().sensors.to_dict()
+
+
+@pytest.mark.parametrize('ext', ['pickle', 'journal'])
+def test_round_trip(tmp_path, ext, make_gateway):
+    """Saved sensors load back with the same states."""
+    path = str(tmp_path / ('sensors.' + ext))
+    gateway = make_gateway(FRAMES)
+    getattr(gateway, '_save_' + ext)(path)
+    loaded = make_gateway()
+    getattr(loaded, '_load_' + ext)(path)
+    assert states(loaded) == states(gateway)
+    assert isinstance(loaded.sensors["IS8000001-1"], Sensor)
+
+
+def test_compact_pickle(tmp_path, make_gateway):
+    """Sensors are saved as (type, desc, value) tuples."""
+    path = str(tmp_path / 'sensors.pickle')
+    gateway = make_gateway(FRAMES)
+    gateway._save_pickle(path)
+    with open(path, 'rb') as file_handle:
+        saved = pickle.load(file_handle)
+    assert saved["IS8000001-1"] == ("input", "", "on")
+
+
+@pytest.mark.parametrize('old', [
+    lambda nid, sensor: Sensor(nid, sensor.type, sensor.desc, sensor.value),
+    lambda nid, sensor: {"id": nid, "type": sensor.type.value,
+                         "desc": sensor.desc, "value": sensor.value},
+])
+def test_load_older_files(tmp_path, old, make_gateway):
+    """Files of Sensor records or plain dicts still load."""
+    path = str(tmp_path / 'sensors.pickle')
+    gateway = make_gateway(FRAMES)
+    with open(path, 'wb') as file_handle:
+        pickle.dump({nid: old(nid, sensor)
+                     for nid, sensor in gateway.sensors.items()}, file_handle)
+    loaded = make_gateway()
+    loaded._load_pickle(path)
+    assert states(loaded) == states(gateway)
+
+
+def test_journal_truncated_record(tmp_path, make_gateway):
+    """A torn last journal record is dropped and appending resumes."""
+    path = str(tmp_path / 'sensors.journal')
+    gateway = make_gateway(FRAMES)
+    gateway._save_journal(path)
+    gateway.logic("IS8  0001I04\r")
+    gateway._changed_ids.update(["IS8000001-1", "IS8000001-3"])
+    gateway._append_journal(path)
+    expected = states(gateway)
+    size = os.path.getsize(path)
+    gateway.logic("IS8  0001I00\r")
+    gateway._changed_ids.add("IS8000001-3")
+    gateway._append_journal(path)
+    with open(path, 'r+b') as file_handle:
+        file_handle.truncate(os.path.getsize(path) - 3)
+
+    loaded = make_gateway()
+    loaded._load_journal(path)
+    assert states(loaded) == expected
+    assert os.path.getsize(path) == size
+    loaded.logic("IS8  0001I00\r")
+    loaded._changed_ids.add("IS8000001-3")
+    loaded._append_journal(path)
+    again = make_gateway()
+    again._load_journal(path)
+    assert again.sensors["IS8000001-3"].value == "off"
+
+
+def test_type_formats_as_string(make_gateway):
+    """The type of the mapping view prints as the plain string."""
+    sensor = make_gateway(FRAMES).sensors["IS8000001-1"]
+    assert sensor["type"] == "input"
+    assert str(sensor["type"]) == "input"
+    assert '%s' % sensor["type"] == "input"
+    assert '{}|{:>6}'.format(sensor["type"], SensorType.CLOCK) == \
+        'input| clock'
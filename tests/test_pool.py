@@ -0,0 +1,52 @@
+"""Tests for GatewayPool against a fake DETH01."""
+import asyncio
+import time
+
+from domintell.pool import GatewayPool
+
+
+def counter(gateway, name):
+    """Return a counter of the gateway metrics."""
+    return gateway.stats()['counters'].get(name, 0)
+
+
+def test_retry_after_backoff(server):
+    """A failed LOGIN is retried after the backoff, not a keepalive."""
+    async def run():
+        pool = GatewayPool(keepalive_interval=5)
+        gateway = pool.add_gateway(server.address[0], port=server.address[1],
+                                   timeout=0.2, reconnect_timeout=0.5)
+        server.ignored.add("LOGIN")
+        begin = time.monotonic()
+        await pool.start()
+        await asyncio.sleep(0.1)
+        server.ignored.clear()
+        await gateway.wait_ready(5)
+        assert time.monotonic() - begin < 2
+        await pool.stop()
+
+    asyncio.run(asyncio.wait_for(run(), 10))
+
+
+def test_reconnect_after_missing_pong(server):
+    """A gateway not answering PING gets a new LOGIN."""
+    async def run():
+        pool = GatewayPool(keepalive_interval=0.2)
+        gateway = pool.add_gateway(server.address[0], port=server.address[1])
+        gateway.enable_metrics()
+        gateway.pong_timeout = 0.1
+        await pool.start()
+        await gateway.wait_ready(2)
+        server.ignored.add("PING")
+        while counter(gateway, 'reconnects') < 1:
+            await asyncio.sleep(0.01)
+        server.ignored.clear()
+        pong = gateway.last_pong
+        while gateway.last_pong == pong:
+            await asyncio.sleep(0.01)
+        server.send_lines(["IS8  0001I01"])
+        while "IS8000001-1" not in gateway.snapshot().sensors:
+            await asyncio.sleep(0.01)
+        await pool.stop()
+
+    asyncio.run(asyncio.wait_for(run(), 10))
@@ -0,0 +1,58 @@
+"""Tests for snapshot, get_many and changes_since."""
+# pylint: disable=protected-access
+import domintell.domintell
+
+FRAMES = ["IS8  0001I00\r", "BIR  0002O00\r"]
+
+
+def test_changes_since(make_gateway):
+    """Only the sensors changed after a version are returned."""
+    gateway = make_gateway(FRAMES)
+    version = gateway.version
+    gateway.logic("IS8  0001I01\r")
+    gateway.logic("BIR  0002O02\r")
+    changes = gateway.changes_since(version)
+    assert not changes.reset
+    assert changes.version == gateway.version
+    assert {nid: state.value for nid, state in changes.sensors.items()} == {
+        "IS8000001-1": "on", "BIR000002-2": "on"}
+    assert not gateway.changes_since(gateway.version).sensors
+
+
+def test_changes_since_cut_chain(make_gateway, monkeypatch):
+    """Versions older than the kept change log get all states."""
+    monkeypatch.setattr(domintell.domintell, 'CHANGE_LOG_SIZE', 3)
+    gateway = make_gateway(FRAMES)
+    versions = [gateway.version]
+    for mask in range(1, 6):
+        gateway.logic("IS8  0001I%02X\r" % mask)
+        versions.append(gateway.version)
+    old = gateway.changes_since(versions[0])
+    assert old.reset
+    assert dict(old.sensors) == gateway.snapshot().sensors.to_dict()
+    recent = gateway.changes_since(versions[-3])
+    assert not recent.reset
+    assert set(recent.sensors) == {"IS8000001-1", "IS8000001-2",
+                                   "IS8000001-3"}
+
+
+def test_changes_since_reset_states(make_gateway, tmp_path):
+    """Versions before the sensors were replaced get all states."""
+    path = str(tmp_path / 'sensors.pickle')
+    gateway = make_gateway(FRAMES)
+    gateway._save_pickle(path)
+    version = gateway.version
+    gateway._load_pickle(path)
+    changes = gateway.changes_since(version)
+    assert changes.reset
+    assert len(changes.sensors) == len(gateway.sensors)
+    assert not gateway.changes_since(gateway.version).reset
+
+
+def test_get_many_unknown_ids(make_gateway):
+    """Unknown ids are left out of get_many."""
+    gateway = make_gateway(FRAMES)
+    view = gateway.get_many(["IS8000001-1", "XXX000001-1", "BIR000002-3"])
+    assert view.version == gateway.version
+    assert set(view.sensors) == {"IS8000001-1", "BIR000002-3"}
+    assert not gateway.get_many(["XXX000001-1"]).sensors
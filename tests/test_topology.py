@@ -0,0 +1,57 @@
+"""Tests for the cached APPINFO topology."""
+
+APPINFO = ["APPINFO\r", "BIR  0002-1Kitchen\r", "BIR  0002-2Hall\r",
+           "END APPINFO\r"]
+
+
+class Recorder(object):
+    """Event callback recording (update type, data)."""
+
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, update_type, data):
+        self.events.append((update_type, data))
+
+    def of_type(self, update_type):
+        """Return the data of the events of a type."""
+        return [data for kind, data in self.events if kind == update_type]
+
+
+def test_no_events_without_cache(make_gateway):
+    """A first APPINFO does not report topology changes."""
+    events = Recorder()
+    gateway = make_gateway(event_callback=events)
+    for line in APPINFO:
+        gateway.logic(line)
+    assert gateway.sensors["BIR000002-1"].desc == "Kitchen"
+    assert not events.of_type('topology_update')
+
+
+def test_events_for_changed_entries(make_gateway):
+    """Entries differing from the loaded cache are reported."""
+    gateway = make_gateway(topology_cache=True)
+    for line in APPINFO:
+        gateway.logic(line)
+    events = Recorder()
+    warm = make_gateway(event_callback=events, topology_cache=True)
+    assert warm.sensors["BIR000002-1"].desc == "Kitchen"
+    for line in APPINFO:
+        warm.logic(line.replace("Hall", "Entrance"))
+    assert events.of_type('topology_update') == ["BIR000002-2"]
+    assert warm.sensors["BIR000002-2"].desc == "Entrance"
+
+
+def test_batched_events(make_gateway):
+    """In batch mode, changes are delivered as one list at END APPINFO."""
+    gateway = make_gateway(topology_cache=True)
+    for line in APPINFO:
+        gateway.logic(line)
+    events = Recorder()
+    warm = make_gateway(event_callback=events, topology_cache=True)
+    warm.batch_events = True
+    warm.batch_window = 60.0
+    for line in APPINFO:
+        warm.logic(line.replace("Kitchen", "Pantry").replace("Hall", "Way"))
+    assert events.events == [
+        ('topology_update', ["BIR000002-1", "BIR000002-2"])]